@@ -1,82 +1,163 @@
 # HELPER FUNCTIONS FOR BIT MANIPULATION
-import re
-
-
-def byte_to_bits(byte_value):
-    # Take byte as output by python's read() and format to string of bits
-    return format(byte_value, '08b')
-
-
-def bits_to_byte(bits):
-    # Take string of bits and output byte data
-    return int(bits, 2).to_bytes(len(bits) // 8, byteorder='big')
-
-
-def reverse_bits(bits):
-    return bits[::-1]
-
-
-def bit_string_to_int(bit_string):
-    # Translate string of bits to int
-    out = 0
-    for bit in bit_string:
-        out = (out << 1) | int(bit)
-    return out
-
-
-def int_to_bit_list(n, min_size):
-    # Translate int to workable list of bits with zero padding
-    bits = [1 if digit == '1' else 0 for digit in bin(n)[2:]]
-    if len(bits) < min_size:
-        bits = [0] * (min_size - len(bits)) + bits
-    return bits
+import item_data
 
 
 def read_bits(data, offset, size):
     # Take byte data and read bits specified by offset and size (number of bits to read), while performing all of the
     # required manipulations due to the way diablo 2 handles bit data. Return int value of bits.
-    byte_start = int(offset / 8)  # Since python can't read individual bits, we need to read the entire byte range
-    byte_end = int((offset + size) / 8)
-    bytes_to_read = byte_end - byte_start + 1
-    result = []
-
-    for byte_idx in range(bytes_to_read):
-        byte = byte_start + byte_idx  # Current byte to read
-        bits_raw = reverse_bits(byte_to_bits(data[byte]))  # Convert byte to bit data and reverse due to endian
-        # Next, create a mask of which bits we are actually interested in and filter the bit data using the mask
-        bits_to_read = [1 if offset <= byte * 8 + bit_idx < offset + size
-                        else 0
-                        for bit_idx in range(8)]
-        bits = [i for (i, v) in zip(bits_raw, bits_to_read) if v]
-        result = result + bits  # Add to result
-
-    return bit_string_to_int(reverse_bits(result))  # Flip bits again due to endian, translate to int and return
+    return BitReader(data).read_at(offset, size)
+
+
+class BitReader:
+    # Reader for the bit fields of an item. Diablo 2 stores bit fields little endian, i.e. the first bit of a field is
+    # the lowest bit of its first byte, so a field can be extracted by loading the byte window covering it as a single
+    # little endian int and shifting/masking it. The reader keeps a cursor so consecutive fields can be read in order.
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def read_at(self, offset, size):
+        # Return int value of size bits starting at offset, without moving the cursor
+        byte_start = offset >> 3
+        byte_end = (offset + size + 7) >> 3
+        if byte_end > len(self.data):
+            raise IndexError("bit range exceeds item data")
+        window = int.from_bytes(self.data[byte_start:byte_end], byteorder='little')
+        return (window >> (offset & 7)) & ((1 << size) - 1)
+
+    def read(self, size):
+        # Return int value of the next size bits and advance the cursor
+        value = self.read_at(self.offset, size)
+        self.offset += size
+        return value
+
+    def skip(self, size):
+        self.offset += size
+
+    def read_chars(self, char_count, bits_per_char):
+        # Read a space terminated string of at most char_count characters
+        chars = ''
+        for _ in range(char_count):  # Reach each char individually
+            char = chr(self.read(bits_per_char))
+            if char == ' ':
+                break
+            chars += char
+        return chars
+
+    def read_magic_properties(self):
+        # Read a list of magic properties (terminated by property id 511) and return them as {property_id: [values]}
+        properties = {}
+        while True:
+            try:
+                property_id = self.read(9)
+            except IndexError:
+                # not sure what is appended after some items but all visible properties are read correctly
+                break
+            if property_id == 511:
+                break
+            magic_property = item_data.get_magic_property(property_id)
+            values = []
+            for bit_length in magic_property.bits:
+                values.append(self.read(bit_length) - magic_property.bias)
+            properties[property_id] = values
+        return properties
+
+    def skip_magic_properties(self):
+        # Advance the cursor past a list of magic properties without decoding their values
+        while True:
+            try:
+                property_id = self.read(9)
+            except IndexError:
+                break
+            if property_id == 511:
+                break
+            self.skip(sum(item_data.get_magic_property(property_id).bits))
+
+
+def int_to_chars(value, char_count, bits_per_char):
+    # Translate int holding char_count little endian chars into a string, stopping at the first space
+    chars = ''
+    for _ in range(char_count):
+        char = chr(value & ((1 << bits_per_char) - 1))
+        value >>= bits_per_char
+        if char == ' ':
+            break
+        chars += char
+    return chars
+
+
+class BitField:
+    # Field of a declarative bit schema: the attribute name (None for unknown or irrelevant bits), its width in bits, an
+    # optional condition on a previously decoded attribute ("is_ear", or "!is_ear" to negate) which must hold for the
+    # field to be present, and an optional function converting the raw int value.
+    def __init__(self, name, width, condition=None, convert=None):
+        self.name = name
+        self.width = width
+        self.condition = condition
+        self.convert = convert
+
+
+def compile_bit_schema(schema, function_name='decode'):
+    # Compile a list of BitFields into a specialized function decode(target, data). It loads all bytes the schema can
+    # cover as one little endian int, sets every present field as attribute of target using plain shifts and masks and
+    # returns the bit offset after the last field. Field offsets are constants until the first conditional field, after
+    # which they are tracked in a local variable.
+    namespace = {}
+    total_bits = sum(field.width for field in schema)
+    lines = ['def %s(target, data):' % function_name,
+             '    window = int.from_bytes(data[:%d], byteorder="little")' % ((total_bits + 7) // 8)]
+    offset = 0  # Known offset of the current field, None once it depends on a condition
+    for idx, field in enumerate(schema):
+        indent = '    '
+        if field.condition is not None:
+            if offset is not None:
+                lines.append('    offset = %d' % offset)
+                offset = None
+            negate = 'not ' if field.condition.startswith('!') else ''
+            lines.append('    if %starget.%s:' % (negate, field.condition.lstrip('!')))
+            indent = '        '
+        if field.name is not None:
+            value = '(window >> %s) & %d' % (offset if offset is not None else 'offset', (1 << field.width) - 1)
+            if field.convert is not None:
+                namespace['convert_%d' % idx] = field.convert
+                value = 'convert_%d(%s)' % (idx, value)
+            lines.append('%starget.%s = %s' % (indent, field.name, value))
+        if offset is not None:
+            offset += field.width
+        else:
+            lines.append('%soffset += %d' % (indent, field.width))
+    lines.append('    return %s' % (offset if offset is not None else 'offset'))
+    exec('\n'.join(lines), namespace)
+    return namespace[function_name]
 
 
 def write_bits(data, offset, size, value_to_write):
     # Take int value and replace the desired range in given byte data, zero padding as necessary according to the
-    # given size, while performing the required bit manipulations.
-    value_reversed = reverse_bits(int_to_bit_list(value_to_write, size))  # First translate int to bit list and reverse
-    byte_start = int(offset / 8)  # Since python can't read individual bits, we need to replace the entire byte range
-    byte_end = int((offset + size - 1) / 8)
-    bytes_to_read = byte_end - byte_start + 1
-    data_new = data[:byte_start]  # Binary literals in python are immutable, so we need to create a new byte object.
-    # Anything up to the starting byte remains unchanged to we can copy from the original.
-
-    for byte_idx in range(bytes_to_read):
-        byte = byte_start + byte_idx
-        bits_raw = reverse_bits(byte_to_bits(data[byte]))  # Convert byte to bit data and reverse due to endian
-        bits_new = ''
-        for bit_idx, bit in enumerate(bits_raw):  # For each bit, check if we need to replace it. If we do, pop from the
-            # prepared bit list. If not (i.e. we have either not reached or already passed the range we want to replace)
-            # then simply use the original data
-            if offset <= byte * 8 + bit_idx < offset + size:
-                bits_new += str(value_reversed.pop(0))
-            else:
-                bits_new += bits_raw[bit_idx]
-        data_new += bits_to_byte(reverse_bits(bits_new))  # Reverse bits in byte due to endian and append to new data
-    data_new += data[byte_end + 1:]  # Finally, everything past the last byte in the range is unchanged
-    return data_new
+    # given size. Return the new byte data; to modify a buffer in place use BitWriter instead.
+    buffer = bytearray(data)
+    BitWriter(buffer).write_at(offset, size, value_to_write)
+    return bytes(buffer)
+
+
+class BitWriter(BitReader):
+    # Writer for the bit fields of a mutable (bytearray) item buffer. Fields are patched in place by masking the value
+    # into the little endian int window covering them, so no new byte object is created per written field.
+    def write_at(self, offset, size, value):
+        # Replace size bits starting at offset with value, without moving the cursor
+        byte_start = offset >> 3
+        byte_end = (offset + size + 7) >> 3
+        if byte_end > len(self.data):
+            raise IndexError("bit range exceeds item data")
+        shift = offset & 7
+        mask = ((1 << size) - 1) << shift
+        window = int.from_bytes(self.data[byte_start:byte_end], byteorder='little')
+        window = (window & ~mask) | ((value << shift) & mask)
+        self.data[byte_start:byte_end] = window.to_bytes(byte_end - byte_start, byteorder='little')
+
+    def write(self, size, value):
+        # Write value into the next size bits and advance the cursor
+        self.write_at(self.offset, size, value)
+        self.offset += size
 
 
 def find_next_null(data, start):
@@ -85,16 +166,3 @@ def find_next_null(data, start):
     while cur < len(data) and data[cur] != 0:
         cur += 1
     return cur
-
-
-def get_data_chunks(data, header):
-    # Get data and split into "chunks", each chunk being all the data from one appearance of the header until
-    # either the next appearance or EOD
-    chunks = []
-    chunk_locs = [m.start() for m in re.finditer(header, data)] + [len(data)]
-    for idx, loc in enumerate(chunk_locs):
-        if idx == len(chunk_locs) - 1:
-            continue
-        next_loc = chunk_locs[idx + 1]
-        chunks.append(data[loc: next_loc])
-    return chunks
\ No newline at end of file
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from operator import attrgetter
+
+from item_data import ItemType, ItemQuality
+from packing import packing_strategies
+
+
+# Sort key of a missing (or None) attribute. Present values get the key (1, value), so items without an attribute sort
+# before all items with it, and None is never compared with an int, enum or string.
+MISSING = (0,)
+
+# Groups of at least this many items whose sort attributes are all small ints (or missing) are sorted by counting sort.
+# Below this, list.sort is at least as fast.
+COUNTING_SORT_MIN_ITEMS = 2000
+COUNTING_SORT_MAX_VALUE = 255
+
+
+def compile_sort_key(attributes):
+    # Return a function computing the sort key tuple of an item for the given list of attribute names
+    def sort_key(item):
+        key = []
+        for name in attributes:
+            value = getattr(item, name, None)
+            key.append(MISSING if value is None else (1, value))
+        return tuple(key)
+    return sort_key
+
+
+def is_small_int(value):
+    return value is None or isinstance(value, int) and 0 <= value <= COUNTING_SORT_MAX_VALUE
+
+
+def sort_items(items, attributes, sort_key):
+    # Sort the list of items in place by the given attributes, sort_key being compile_sort_key(attributes). Large groups
+    # keyed only by small ints (quality, level, type, ...) are sorted by a stable LSD counting sort, which gives the same
+    # order as sorting by sort_key.
+    if attributes and len(items) >= COUNTING_SORT_MIN_ITEMS:
+        rows = [(item, [getattr(item, name, None) for name in attributes]) for item in items]
+        if all(is_small_int(value) for _, values in rows for value in values):
+            for idx in reversed(range(len(attributes))):
+                # Only bucket over the range of the values present, bucket 0 holding the missing ones
+                values = [values[idx] for _, values in rows if values[idx] is not None]
+                low = min(values, default=0)
+                buckets = [[] for _ in range(max(values, default=0) - low + 2)]
+                for row in rows:
+                    value = row[1][idx]
+                    buckets[0 if value is None else value - low + 1].append(row)
+                rows = [row for bucket in buckets for row in bucket]
+            items[:] = [item for item, _ in rows]
+            return
+    items.sort(key=sort_key)
+
+
+def split_setting(value):
+    # Split a comma separated setting into its stripped values
+    return [x.strip() for x in value.split(',')]
+
+
+class GroupRule:
+    # An ITEM_GROUP_ section of the settings, compiled for matching items against it. Item types and qualities are
+    # kept as sets and attribute checks as getters, so nothing has to be parsed or looked up by name per item.
+    def __init__(self, name, section):
+        self.name = name
+
+        self.types = None  # None means items of any type may be added to the group
+        if "ItemType" in section:
+            self.types = frozenset(ItemType[t] for t in split_setting(section["ItemType"]))
+
+        self.qualities = None  # None means items of any quality may be added to the group
+        if "ItemQuality" in section:
+            self.qualities = frozenset(ItemQuality[q] for q in split_setting(section["ItemQuality"]))
+
+        self.attributes = None  # List of (getter, value to check against), one of which has to match
+        self.attribute_names = []
+        if "Attribute" in section:
+            self.attributes = []
+            for a in split_setting(section["Attribute"]):
+                check_against = 1
+                if a[0] == "!":
+                    check_against = 0
+                    a = a[1:]
+                self.attributes.append((attrgetter(a), check_against))
+                self.attribute_names.append(a)
+
+        self.sub_group_by = section.get("SubGroupByAttribute")  # None if the group is not split into sub groups
+
+        self.sort_by = []
+        if "SortByAttribute" in section:
+            self.sort_by = split_setting(section["SortByAttribute"])
+
+        self.sort_sub_groups_by = [self.sub_group_by]
+        if "SortSubGroupsByAttribute" in section:
+            self.sort_sub_groups_by = split_setting(section["SortSubGroupsByAttribute"])
+
+        self.packing_strategy = section.get("PackingStrategy", "ordered")  # See packing.pack
+        if self.packing_strategy not in packing_strategies:
+            raise ValueError("Unknown PackingStrategy %s of group %s" % (self.packing_strategy, name))
+        self.packing_time_limit = int(section.get("PackingTimeLimit", "100"))  # In milliseconds
+
+        self.sort_key = compile_sort_key(self.sort_by)
+        self.sub_group_sort_key = compile_sort_key(self.sort_sub_groups_by)
+
+    def sort_group(self, group):
+        # Sort the items of the group, or of each sub group and the sub groups themselves (by their first item)
+        if self.sub_group_by is None:
+            sort_items(group, self.sort_by, self.sort_key)
+            return group
+        for sub_group in group.values():
+            sort_items(sub_group, self.sort_by, self.sort_key)
+        return OrderedDict(sorted(group.items(), key=lambda x: self.sub_group_sort_key(x[1][0])))
+
+    def matches(self, item):
+        # Check if the item may be added to the group. The item type is already checked by GroupingPlan.
+        if self.qualities is not None and item.quality not in self.qualities:
+            return False
+        if self.attributes is not None:
+            return any(getter(item) == check_against for getter, check_against in self.attributes)
+        return True
+
+
+class GroupingPlan:
+    # The ITEM_GROUP_ sections of the settings, compiled once into GroupRules in the order in which they appear in the
+    # settings. For every item type the rules which accept that type are indexed beforehand, so an item is only checked
+    # against the groups it can belong to. The plan does not depend on any stash and can be reused.
+    def __init__(self, config):
+        self.rules = []
+        for section in config:
+            if section.startswith('ITEM_GROUP_'):
+                self.rules.append(GroupRule(section[11:], config[section]))
+
+        # Items which do not fit into any group are put into the MISC group, which accepts everything if not configured
+        self.misc_rule = next((rule for rule in self.rules if rule.name == "MISC"), None)
+        if self.misc_rule is None:
+            self.misc_rule = GroupRule("MISC", {})
+            self.rules.append(self.misc_rule)
+
+        self.rules_by_type = {}
+        for item_type in ItemType:
+            self.rules_by_type[item_type] = [rule for rule in self.rules if rule.types is None or item_type in rule.types]
+
+        # Which group an item belongs to only depends on its type, quality and the attributes checked by the rules. Items
+        # which are identical in these (e.g. all Ist runes) form one signature, which only has to be matched once.
+        self.signature_attributes = []
+        for rule in self.rules:
+            for name in rule.attribute_names:
+                if name not in self.signature_attributes:
+                    self.signature_attributes.append(name)
+        self.rules_by_signature = {}
+
+    def get_signature(self, item):
+        return (item.type, item.quality) + tuple(getattr(item, name, None) for name in self.signature_attributes)
+
+    def get_rule(self, item):
+        # Return the rule of the first group the item may be added to
+        signature = self.get_signature(item)
+        rule = self.rules_by_signature.get(signature)
+        if rule is None:
+            rule = self.match_rule(item)
+            self.rules_by_signature[signature] = rule
+        return rule
+
+    def match_rule(self, item):
+        for rule in self.rules_by_type[item.type]:
+            if rule.matches(item):
+                return rule
+        return self.misc_rule
@@ -0,0 +1,123 @@
+import zlib
+from collections import Counter, OrderedDict
+
+from grouping import sort_items
+from packing import pack
+from page import Page
+
+
+def get_group_key(grouping_plan, item):
+    # Return (rule, sub group) of the group the item belongs to, which identifies the pages of the group
+    rule = grouping_plan.get_rule(item)
+    if rule.sub_group_by is None:
+        return rule, None
+    return rule, getattr(item, rule.sub_group_by)
+
+
+def get_page_group_keys(grouping_plan, item_records):
+    # Return the group keys of the items on a page, and the key of the group the page belongs to, i.e. the group more
+    # than half of its items belong to. If there is no such group, e.g. on a page of items the player dropped there, the
+    # page belongs to no group and its key is None.
+    keys = [get_group_key(grouping_plan, item) for _, _, item in item_records]
+    key, count = Counter(keys).most_common(1)[0]
+    return keys, key if 2 * count > len(keys) else None
+
+
+def get_page_marker(items_data):
+    # Return the marker make_stash writes as name of a page it builds, a checksum of the data of the page's items in the
+    # order they are written. It lets an incremental organize tell which items of a page it put there.
+    checksum = 0
+    for data in items_data:
+        checksum = zlib.crc32(data, checksum)
+    return b'%08x' % checksum
+
+
+def get_num_marked_items(stash_data, page_name, item_records):
+    # Return the number of items at the start of a page which the page's marker covers (see get_page_marker), i.e. the
+    # items which were on the page when it was written, or 0 if the page has no marker. Items added to a page later
+    # follow these items.
+    stash_view = memoryview(stash_data)
+    checksum = 0
+    for idx, (start, end, _) in enumerate(item_records):
+        checksum = zlib.crc32(stash_view[start: end], checksum)
+        if page_name == b'%08x' % checksum:
+            return idx + 1
+    return 0
+
+
+def read_organized_pages(stash_data, stash_pages, page_names, grouping_plan):
+    # Return the pages of an already organized stash as a list of (group key, Page, new items), or None if the stash is
+    # not organized. The items covered by a page's marker (see get_num_marked_items) are where organizing the stash put
+    # them. If they all belong to a single group, in the order of the groups, they stay on the page as a page of that
+    # group. All other items are new: items added to a page, or on pages without a marker (e.g. pages the player added),
+    # on pages of a group which already had pages before another group, or on pages out of the order of the groups.
+    # Pages keep their stash data if they have no new items. Pages without items which stay are left out, as (None,
+    # None, new items). A stash is organized if at least one page has items which stay.
+    stash_view = memoryview(stash_data)
+    rule_indices = {rule: idx for idx, rule in enumerate(grouping_plan.rules)}
+    organized_pages = []
+    keys_seen = set()
+    previous_key = None
+    for (start, end, item_records), page_name in zip(stash_pages, page_names):
+        num_marked = get_num_marked_items(stash_data, page_name, item_records)
+        keys = {get_group_key(grouping_plan, item) for _, _, item in item_records[:num_marked]}
+        key = keys.pop() if len(keys) == 1 else None
+        if key is not None and previous_key is not None and key != previous_key:
+            if key in keys_seen or rule_indices[key[0]] < rule_indices[previous_key[0]]:
+                key = None
+        if key is None:
+            organized_pages.append((None, None, [item for _, _, item in item_records]))
+            continue
+        page = Page()
+        new_items = []
+        for idx, (_, _, item) in enumerate(item_records):
+            if idx >= num_marked or not page.place_item(item):
+                new_items.append(item)
+        if not new_items:
+            page.data = stash_view[start: end]
+        keys_seen.add(key)
+        previous_key = key
+        organized_pages.append((key, page, new_items))
+    if previous_key is None:
+        return None
+    return organized_pages
+
+
+def insert_new_items(stash_data, stash_pages, page_names, grouping_plan):
+    # Insert the new items of an already organized stash into the free space of the pages of their groups, adding pages
+    # only for groups which are full or new. All other pages are left as they are. Return the list of pages, or None if
+    # the stash is not organized. page_names are the names of stash_pages, holding their markers.
+    organized_pages = read_organized_pages(stash_data, stash_pages, page_names, grouping_plan)
+    if organized_pages is None:
+        return None
+
+    groups = OrderedDict()  # Pages of each group, in stash order
+    new_items = OrderedDict()  # New items of each group
+    for key, page, page_new_items in organized_pages:
+        if key is not None:
+            groups.setdefault(key, []).append(page)
+        for item in page_new_items:
+            new_items.setdefault(get_group_key(grouping_plan, item), []).append(item)
+
+    rule_indices = {rule: idx for idx, rule in enumerate(grouping_plan.rules)}
+    for key, items in new_items.items():
+        rule = key[0]
+        sort_items(items, rule.sort_by, rule.sort_key)
+        if key in groups:
+            pages = groups[key]
+            items = [item for item in items if not any(page.insert_item(item) for page in pages)]
+            if items:
+                pages.extend(pack(items, rule.packing_strategy, rule.packing_time_limit))
+        else:
+            # A new group goes behind the last group of the same or an earlier rule
+            keys = list(groups)
+            position = len([x for x in keys if rule_indices[x[0]] <= rule_indices[rule]])
+            groups[key] = pack(items, rule.packing_strategy, rule.packing_time_limit)
+            for x in keys[position:]:
+                groups.move_to_end(x)
+
+    num_new_items = sum(len(items) for items in new_items.values())
+    pages = [page for group_pages in groups.values() for page in group_pages]
+    num_unchanged = len([page for page in pages if page.data is not None])
+    print("Incremental organize: %d new items, %d of %d pages unchanged" % (num_new_items, num_unchanged, len(pages)))
+    return pages
@@ -1,47 +1,85 @@
+import sys
 from copy import deepcopy
+from enum import Enum
 
 import item_data
-from bit_utils import read_bits, write_bits, get_data_chunks
-from item_data import ItemType, ItemQuality, ItemVersion
+from bit_utils import BitReader, BitWriter, BitField, compile_bit_schema, int_to_chars
+from item_data import ItemClass, ItemQuality, ItemVersion
+
+# Layout of the fixed item header which every item (simple or extended) starts with. It is compiled into
+# decode_item_header below, which reads all of these fields from a single int load of the first bytes of the item.
+# Mods or PlugY versions with a different header only need a different schema.
+item_header_schema = [
+    BitField(None, 20),  # 'JM' and unknown bits
+    BitField('is_identified', 1),  # offset: 20
+    BitField(None, 6),  # unknown bits
+    BitField('has_sockets', 1),  # offset: 27
+    BitField(None, 1),  # unknown bits
+    BitField(None, 1),  # irrelevant bit: is_new
+    BitField(None, 2),  # unknown bits
+    BitField('is_ear', 1),  # offset: 32
+    BitField(None, 1),  # irrelevant bit: is_starter_item
+    BitField(None, 3),  # unknown bits
+    BitField('is_simple', 1),  # offset: 37
+    BitField('is_ethereal', 1),  # offset: 38
+    BitField(None, 1),  # unknown bit
+    BitField('is_personalized', 1),  # offset: 40
+    BitField(None, 1),  # unknown bit
+    BitField('is_runeword', 1),  # offset: 42
+    BitField(None, 5),  # unknown bits
+    BitField('version', 8, convert=ItemVersion),  # offset: 48
+    BitField(None, 2),  # unknown bits
+    BitField('location_id', 3),  # offset: 58
+    BitField(None, 4),  # irrelevant bits: equipped_id
+    BitField(None, 4),  # irrelevant bits: position_x
+    BitField(None, 3),  # irrelevant bits: position_y
+    BitField(None, 1),  # unknown bit
+    BitField(None, 3),  # irrelevant bits: alt_position_id
+    BitField('ear_class', 3, 'is_ear'),  # offset: 76
+    BitField('ear_level', 7, 'is_ear'),  # offset: 79
+    BitField('code', 32, '!is_ear', lambda value: int_to_chars(value, 4, 8)),  # offset: 76
+]
+decode_item_header = compile_bit_schema(item_header_schema, 'decode_item_header')
+
+# Bits of the item code (offset 76) in the item data read as a little endian int
+CODE_BITS = 0xFFFFFFFF << 76
 
 
 # Item class, holding the various relevant item-related attributes and methods
 class Item:
-    def __init__(self, data):
-        self.data = data  # The byte data
-
-        offset = 20
-        self.is_identified, offset = self.read_attribute(data, offset, 1)  # offset: 20
-        offset += 6  # unknown bits
-        self.has_sockets, offset = self.read_attribute(data, offset, 1)  # offset: 27
-        offset += 1  # unknown bits
-        offset += 1  # irrelevant bit: is_new
-        offset += 2  # unknown bits
-        self.is_ear, offset = self.read_attribute(data, offset, 1)  # offset: 32
-        offset += 1  # irrelevant bit: is_starter_item
-        offset += 3  # unknown bits
-        self.is_simple, offset = self.read_attribute(data, offset, 1)  # offset: 37
-        self.is_ethereal, offset = self.read_attribute(data, offset, 1)  # offset: 38
-        offset += 1  # unknown bit
-        self.is_personalized, offset = self.read_attribute(data, offset, 1)  # offset: 40
-        offset += 1  # unknown bit
-        self.is_runeword, offset = self.read_attribute(data, offset, 1)  # offset: 42
-        offset += 5  # unknown bits
-        self.version, offset = self.read_version(self, offset, 8)  # offset: 48
-        offset += 2  # unknown bits
-        self.location_id, offset = self.read_attribute(data, offset, 3)  # offset: 58
-        offset += 4  # irrelevant bits: equipped_id
-        offset += 4  # irrelevant bits: position_x
-        offset += 3  # irrelevant bits: position_y
-        offset += 1  # unknown bit
-        offset += 3  # irrelevant bits: alt_position_id
+    # Items only have slots instead of a __dict__. Attributes which don't apply to an item (e.g. set_name for a rune)
+    # are simply left unset, so they take no memory besides their slot.
+    __slots__ = (
+        # Item data and structure
+        'data', 'length', 'properties_offset', 'socketables', 'x_size', 'y_size',
+        # Header
+        'is_identified', 'has_sockets', 'is_ear', 'is_simple', 'is_ethereal', 'is_personalized', 'is_runeword',
+        'version', 'location_id', 'ear_class', 'ear_level', 'ear_data', 'code', 'type', 'gem_quality', 'name',
+        # Extended items
+        'num_filled_sockets', 'identifier', 'level', 'quality', 'has_multiple_pictures', 'picture_id',
+        'is_class_specific', 'class_specific_data', 'prefix_id', 'suffix_id', 'set_item_id', 'set_item_name', 'set_id',
+        'set_name', 'set_difficulty', 'unique_id', 'unique_name', 'rare_name_id1', 'rare_name1', 'rare_name_id2',
+        'rare_name2', 'prefix_ids', 'suffix_ids', 'runeword_id', 'runeword_name', 'personalized_data', 'timestamp',
+        'defense', 'max_durability', 'durability', 'quantity', 'num_total_sockets', 'set_list_count',
+        'set_attributes_ids_req', 'set_attributes_num_req',
+        # Properties, see lazy_attributes
+        'magic_properties', 'set_properties', 'runeword_properties', 'socketable_properties', 'all_properties',
+        'translated_magic_properties', 'translated_set_properties', 'translated_runeword_properties',
+        'translated_socketable_properties', 'translated_all_properties',
+    )
+
+    def __init__(self, data, socket_starts=None):
+        # data has to start with the item but may extend past it, e.g. a memoryview of the rest of the stash. How many
+        # bytes belong to the item (and the items in its sockets) is determined from the decoded bits.
+        # If socket_starts is given, data was split on b'JM' markers instead and is exactly the item with the items in
+        # its sockets, which start at the offsets in socket_starts. All of data is kept then, including any bytes after
+        # the decoded properties.
+        offset = decode_item_header(self, data)  # offset: 108, or 86 for ears
+        reader = BitReader(data, offset)
 
         if self.is_ear == 1:
-            self.ear_class, offset = self.read_attribute(data, offset, 3)  # offset: 76
-            self.ear_level, offset = self.read_attribute(data, offset, 7)  # offset: 79
-            self.ear_data, offset = self.read_attribute_as_char(data, offset, 15, 7)  # offset: 86
+            self.ear_data = reader.read_chars(15, 7)  # offset: 86
         else:
-            self.code, offset = self.read_attribute_as_char(data, offset, 4, 8)  # offset: 76
             self.type = item_data.get_item_data(self.code).type
             if self.is_gem():
                 self.gem_quality = item_data.get_gem_data_by_code(self.code).quality
@@ -49,27 +87,29 @@ class Item:
         if self.is_simple == 1:
             self.quality = None
             self.num_filled_sockets = 0
+            self.length = (reader.offset + 7) // 8  # Size in bytes of the item itself
+            end = self.length
         else:
-            self.num_filled_sockets, offset = self.read_attribute(data, offset, 3)  # offset: 108
-            self.identifier, offset = self.read_attribute(data, offset, 32)  # offset: 111
-            self.level, offset = self.read_attribute(data, offset, 7)  # offset: 143
-            self.quality, offset = self.read_quality(self, offset, 4)  # offset: 150
+            self.num_filled_sockets = reader.read(3)  # offset: 108
+            self.identifier = reader.read(32)  # offset: 111
+            self.level = reader.read(7)  # offset: 143
+            self.quality = ItemQuality(reader.read(4))  # offset: 150
 
-            self.has_multiple_pictures, offset = self.read_attribute(data, offset, 1)  # offset: 154
+            self.has_multiple_pictures = reader.read(1)  # offset: 154
             if self.has_multiple_pictures == 1:
-                self.picture_id, offset = self.read_attribute(data, offset, 3)
+                self.picture_id = reader.read(3)
 
-            self.is_class_specific, offset = self.read_attribute(data, offset, 1)
+            self.is_class_specific = reader.read(1)
             if self.is_class_specific == 1:
-                self.class_specific_data, offset = self.read_attribute(data, offset, 11)
+                self.class_specific_data = reader.read(11)
 
             if self.quality in (ItemQuality.LOW_QUALITY, ItemQuality.HIGH_QUALITY):
-                offset += 3  # irrelevant bits
+                reader.skip(3)  # irrelevant bits
             elif self.quality == ItemQuality.MAGIC:
-                self.prefix_id, offset = self.read_attribute(data, offset, 11)
-                self.suffix_id, offset = self.read_attribute(data, offset, 11)
+                self.prefix_id = reader.read(11)
+                self.suffix_id = reader.read(11)
             elif self.quality == ItemQuality.SET:
-                self.set_item_id, offset = self.read_attribute(data, offset, 12)
+                self.set_item_id = reader.read(12)
                 set_item_data = item_data.get_set_item_data(self.set_item_id)
                 self.set_item_name = set_item_data.set_item_name
                 self.set_id = set_item_data.set_id
@@ -77,66 +117,59 @@ class Item:
                 self.set_name = set_data.set_name
                 self.set_difficulty = set_data.difficulty
             elif self.quality == ItemQuality.UNIQUE:
-                self.unique_id, offset = self.read_attribute(data, offset, 12)
+                self.unique_id = reader.read(12)
                 self.unique_name = item_data.get_unique_name(self.unique_id)
             elif self.quality in (ItemQuality.RARE, ItemQuality.CRAFTED):
-                self.rare_name_id1, offset = self.read_attribute(data, offset, 8)
+                self.rare_name_id1 = reader.read(8)
                 self.rare_name1 = item_data.get_rare_name(self.rare_name_id1)
-                self.rare_name_id2, offset = self.read_attribute(data, offset, 8)
+                self.rare_name_id2 = reader.read(8)
                 self.rare_name2 = item_data.get_rare_name(self.rare_name_id2)
                 self.prefix_ids = []
                 self.suffix_ids = []
                 for i in range(6):
-                    has_pre_or_suffix, offset = self.read_attribute(data, offset, 1)
+                    has_pre_or_suffix = reader.read(1)
                     if has_pre_or_suffix == 1:
-                        pre_or_suffix_id, offset = self.read_attribute(data, offset, 11)
+                        pre_or_suffix_id = reader.read(11)
                         if (i % 2) == 0:
                             self.prefix_ids.append(pre_or_suffix_id)
                         else:
                             self.suffix_ids.append(pre_or_suffix_id)
 
             if self.is_runeword == 1:
-                self.runeword_id, offset = self.read_attribute(data, offset, 12)
+                self.runeword_id = reader.read(12)
                 self.runeword_name = item_data.get_runeword_name(self.runeword_id)
-                offset += 4  # unknown bits
+                reader.skip(4)  # unknown bits
 
             if self.is_personalized == 1:
-                self.personalized_data, offset = self.read_attribute_as_char(data, offset, 15, 7)
+                self.personalized_data = reader.read_chars(15, 7)
 
             if self.is_tome():  # Tomes
-                offset += 5  # unknown bits
+                reader.skip(5)  # unknown bits
 
-            self.timestamp, offset = self.read_attribute(data, offset, 1)
+            self.timestamp = reader.read(1)
 
             if self.is_armor() or self.is_shield():
-                self.defense, offset = self.read_attribute(data, offset, 11)
+                self.defense = reader.read(11)
                 self.defense -= 10  # for an unknown reason this has to be subtracted
 
             if self.is_armor() or self.is_shield() or self.is_weapon():
-                self.max_durability, offset = self.read_attribute(data, offset, 8)
+                self.max_durability = reader.read(8)
                 if self.max_durability > 0:
-                    self.durability, offset = self.read_attribute(data, offset, 8)
-                    offset += 1  # unknown bit
+                    self.durability = reader.read(8)
+                    reader.skip(1)  # unknown bit
 
             if self.is_stackable():
-                self.quantity, offset = self.read_attribute(data, offset, 9)
+                self.quantity = reader.read(9)
 
             if self.has_sockets:
-                self.num_total_sockets, offset = self.read_attribute(data, offset, 4)
+                self.num_total_sockets = reader.read(4)
 
             set_list_count_value = 0
             if self.quality == ItemQuality.SET:
-                set_list_count_value, offset = self.read_attribute(data, offset, 5)
+                set_list_count_value = reader.read(5)
                 self.set_list_count = item_data.get_set_list_count(set_list_count_value)
 
-            offset, properties = self.read_magic_properties(self, offset)
-            self.magic_properties = properties
-
-            self.set_properties = {}
             if self.quality == ItemQuality.SET and self.set_list_count > 0:
-                for i in range(self.set_list_count):
-                    offset, properties = self.read_magic_properties(self, offset)
-                    self.set_properties = self.merge_properties_dicts(self.set_properties, properties)
                 if self.set_id == 0 and self.set_item_id == 0:  # Civerb's Ward
                     self.set_attributes_ids_req = [1, 2]
                 else:
@@ -147,16 +180,28 @@ class Item:
                             continue
                         self.set_attributes_num_req.append(i + 2)
 
-            self.runeword_properties = {}
+            # The magic, set and runeword property lists are only skipped here. They are decoded on first access of
+            # one of their attributes, see lazy_attributes.
+            self.properties_offset = reader.offset
+            reader.skip_magic_properties()
+            if self.quality == ItemQuality.SET:
+                for i in range(self.set_list_count):
+                    reader.skip_magic_properties()
             if self.is_runeword == 1:
-                offset, properties = self.read_magic_properties(self, offset)
-                self.runeword_properties = properties
+                reader.skip_magic_properties()
 
-            chunks = get_data_chunks(self.data, b'JM')[1:]  # socketable items are appended after the actual item
+            self.length = (reader.offset + 7) // 8  # Size in bytes of the item itself, without its socketed items
+
+            # socketable items are appended after the actual item
+            end = self.length
             self.socketables = []
-            self.socketable_properties = {}
-            for chunk in chunks:
-                item_in_socket = Item(chunk)
+            for idx in range(self.num_filled_sockets):
+                if socket_starts is None:
+                    item_in_socket = Item(data[end:])
+                    end += len(item_in_socket.data)
+                else:
+                    socket_end = socket_starts[idx + 1] if idx + 1 < len(socket_starts) else len(data)
+                    item_in_socket = Item(data[socket_starts[idx]:socket_end], [])
                 socketable_item_data = item_data.get_socketable_item_data(item_in_socket.code)
                 if socketable_item_data is not None:
                     item_in_socket.name = socketable_item_data.name
@@ -166,26 +211,51 @@ class Item:
                         item_in_socket.magic_properties = socketable_item_data.armor_properties
                     elif self.is_shield():
                         item_in_socket.magic_properties = socketable_item_data.shield_properties
-                    item_in_socket.translated_magic_properties = self.translate_properties(item_in_socket.magic_properties)
                 self.socketables.append(item_in_socket)
 
-            self.all_properties = self.merge_properties_dicts({}, self.magic_properties)
-            self.all_properties = self.merge_properties_dicts(self.all_properties, self.set_properties)
-            self.all_properties = self.merge_properties_dicts(self.all_properties, self.runeword_properties)
-            self.socketable_properties = {}
-            for socketable in self.socketables:
-                self.socketable_properties = self.merge_properties_dicts(self.socketable_properties, socketable.magic_properties)
-            self.all_properties = self.merge_properties_dicts(self.all_properties, self.socketable_properties)
-
-            self.translated_magic_properties = self.translate_properties(self.magic_properties)
-            self.translated_set_properties = self.translate_properties(self.set_properties)
-            self.translated_runeword_properties = self.translate_properties(self.runeword_properties)
-            self.translated_socketable_properties = self.translate_properties(self.socketable_properties)
-            self.translated_all_properties = self.translate_properties(self.all_properties)
+        # The byte data. If data is a memoryview (of the loaded stash) this is a view into it as well and no bytes are
+        # copied. An own, mutable buffer is only created once the item is actually modified, see get_writer.
+        self.data = data[:end] if socket_starts is None else data
 
         self.x_size = item_data.get_item_size_x(self.code)  # How many horizontal slots does the item take
         self.y_size = item_data.get_item_size_y(self.code)  # How many vertical slots does the item take
 
+    def __getattr__(self, name):
+        # Only called for attributes which are not set (yet): decode the lazy attribute on first access
+        if name in lazy_attributes:
+            lazy_attributes[name](self)
+            return object.__getattribute__(self, name)  # Raises AttributeError if the item has no such attribute
+        raise AttributeError("'Item' object has no attribute '%s'" % name)
+
+    def decode_properties(self):
+        # Decode the magic, set and runeword property lists skipped in __init__
+        if self.is_simple == 1:
+            return
+        reader = BitReader(self.data, self.properties_offset)
+        self.magic_properties = reader.read_magic_properties()
+
+        self.set_properties = {}
+        if self.quality == ItemQuality.SET:
+            for i in range(self.set_list_count):
+                properties = reader.read_magic_properties()
+                self.set_properties = self.merge_properties_dicts(self.set_properties, properties)
+
+        self.runeword_properties = {}
+        if self.is_runeword == 1:
+            self.runeword_properties = reader.read_magic_properties()
+
+    def merge_all_properties(self):
+        # Merge the properties of the item itself and the items in its sockets
+        if self.is_simple == 1:
+            return
+        self.all_properties = self.merge_properties_dicts({}, self.magic_properties)
+        self.all_properties = self.merge_properties_dicts(self.all_properties, self.set_properties)
+        self.all_properties = self.merge_properties_dicts(self.all_properties, self.runeword_properties)
+        self.socketable_properties = {}
+        for socketable in self.socketables:
+            self.socketable_properties = self.merge_properties_dicts(self.socketable_properties, socketable.magic_properties)
+        self.all_properties = self.merge_properties_dicts(self.all_properties, self.socketable_properties)
+
     @staticmethod
     def translate_properties(properties):
         props = deepcopy(properties)
@@ -210,85 +280,90 @@ class Item:
                 dict1[key] = [x + y for x, y in zip(dict1[key], dict2[key])]
         return dict1
 
-    @staticmethod
-    def read_attribute(item, offset, bits_to_read):
-        return read_bits(item, offset, bits_to_read), offset + bits_to_read
-
-    @staticmethod
-    def read_version(self, offset, bits_to_read):
-        version_id, _ = self.read_attribute(self.data, offset, bits_to_read)
-        return ItemVersion(version_id), offset + bits_to_read
-
-    @staticmethod
-    def read_quality(self, offset, bits_to_read):
-        quality_id, _ = self.read_attribute(self.data, offset, bits_to_read)
-        return ItemQuality(quality_id), offset + bits_to_read
-
-    @staticmethod
-    def read_attribute_as_char(item, offset, char_count, bits_per_char):
-        item_code = ''
-        for _ in range(char_count):  # Reach each char individually
-            char = chr(read_bits(item, offset, bits_per_char))
-            offset += bits_per_char
-            if char == ' ':
-                break
-            item_code += char
-        return item_code, offset
-
-    @staticmethod
-    def read_magic_properties(self, offset):
-        properties = {}
-        while True:
+    def get_writer(self, offset=0):
+        # Return a BitWriter for the item data, copying the data into an own mutable buffer on the first modification
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        return BitWriter(self.data, offset)
+
+    def get_position(self):
+        reader = BitReader(self.data, 65)
+        return reader.read(4), reader.read(4)
+
+    def get_memory_size(self):
+        # Approximate number of bytes the item occupies in memory, including the values and containers it holds and its
+        # socketed items. Enum members and the stash data the item is a view of are shared and therefore not counted.
+        size = sys.getsizeof(self)
+        for name in Item.__slots__:
             try:
-                property_id, offset = self.read_attribute(self.data, offset, 9)
-            except IndexError:
-                # not sure what is appended after some items but all visible properties are read correctly
-                break
-            if property_id == 511:
-                break
-            magic_property = item_data.get_magic_property(property_id)
-            values = []
-            for bit_length in magic_property.bits:
-                property_value, offset = self.read_attribute(self.data, offset, bit_length)
-                values.append(property_value - magic_property.bias)
-            properties[property_id] = values
-        return offset, properties
+                value = object.__getattribute__(self, name)
+            except AttributeError:
+                continue
+            if name == 'socketables':
+                size += sys.getsizeof(value) + sum(socketable.get_memory_size() for socketable in value)
+            else:
+                size += get_value_memory_size(value)
+        return size
+
+    def copy(self):
+        # Return a copy of the item with its own data, which can be modified without changing this item. Decoded values
+        # (and socketed items) are shared.
+        item = Item.__new__(Item)
+        for name in Item.__slots__:
+            try:
+                setattr(item, name, object.__getattribute__(self, name))
+            except AttributeError:
+                continue
+        item.data = bytearray(self.data)
+        return item
 
     def set_position(self, x, y):
         # Modify item data and write new stash position
-        self.data = write_bits(self.data, 65, 4, x)
-        self.data = write_bits(self.data, 69, 4, y)
+        if self.get_position() == (x, y):
+            return
+        writer = self.get_writer(65)
+        writer.write(4, x)
+        writer.write(4, y)
 
     def is_stackable(self):
-        return self.type in [ItemType.THROW, ItemType.THROWPOT, ItemType.JAV] or \
-               self.code in ["am5", "ama", "amf", "key", "aqv", "cqv"] or \
-               self.is_tome()
+        return self.code in item_data.stackable_codes
 
     def is_tome(self):
-        return self.code in ["tkb", "ibk"]
+        return self.code in item_data.tome_codes
 
     def is_armor(self):
-        return self.type in [ItemType.BARB, ItemType.BELT, ItemType.BODY, ItemType.BODY, ItemType.BOOTS, ItemType.CIRCLET,
-                             ItemType.GLOVES, ItemType.HELM, ItemType.PELT]
+        return bool(item_data.item_type_classes[self.type] & ItemClass.ARMOR)
 
     def is_shield(self):
-        return self.type in [ItemType.NEC, ItemType.PAL, ItemType.SHIELD]
+        return bool(item_data.item_type_classes[self.type] & ItemClass.SHIELD)
 
     def is_weapon(self):
-        return self.type in [ItemType.AMA, ItemType.ASN, ItemType.AXE, ItemType.BOW, ItemType.DAGGER, ItemType.JAV, ItemType.MACE,
-                             ItemType.POLEARM, ItemType.SCEPTER, ItemType.SORC, ItemType.SPEAR, ItemType.STAFF, ItemType.SWORD,
-                             ItemType.THROW, ItemType.WAND, ItemType.XBOW]
+        return bool(item_data.item_type_classes[self.type] & ItemClass.WEAPON)
 
     def is_gem(self):
-        return self.type in item_data.gems_types
+        return bool(item_data.item_type_classes[self.type] & ItemClass.GEM)
 
     def set_code(self, new_code):
-        # Get new 3-letter item code and replace the old one
-        for i in range(3):
-            self.data = write_bits(self.data, 76 + i * 8, 8, ord(new_code[i]))
-        self.data = write_bits(self.data, 100, 8, ord(' '))
+        # Get new 3-letter item code and replace the old one. The code is stored as 4 space padded 8-bit chars, which
+        # written in order are exactly the little endian int of the padded code.
+        if new_code == self.code:
+            return
+        if self.is_simple == 1:
+            # Simple items are short, so the whole data is rewritten at once as a single int with the code bits replaced
+            value = int.from_bytes(self.data, byteorder='little')
+            value = value & ~CODE_BITS | get_code_value(new_code) << 76
+            self.data = value.to_bytes(len(self.data), byteorder='little')
+        else:
+            self.get_writer().write_at(76, 32, get_code_value(new_code))
         self.code = new_code
 
+        # Update the attributes which depend on the code
+        self.type = item_data.get_item_data(self.code).type
+        if self.is_gem():
+            self.gem_quality = item_data.get_gem_data_by_code(self.code).quality
+        self.x_size = item_data.get_item_size_x(self.code)
+        self.y_size = item_data.get_item_size_y(self.code)
+
     def __str__(self):
         arr = [self.type, self.quality, item_data.get_item_data(self.code).name]
         if self.is_simple == 0:
@@ -308,3 +383,109 @@ class Item:
                 arr.append(self.runeword_name)
             arr.append("[" + ', '.join(self.translated_all_properties) + "]")
         return ', '.join(str(i) for i in arr)
+
+
+def get_item_length(data):
+    # Return the number of bytes of the item at the start of data, including the items in its sockets, like
+    # len(Item(data).data). Only the bits which determine the length are read, so this is much cheaper than decoding the
+    # item, for items which are passed through unchanged.
+    reader = BitReader(data)
+    if reader.read_at(32, 1) == 1:  # Ear
+        reader.offset = 86
+        reader.read_chars(15, 7)
+        return (reader.offset + 7) // 8
+    reader.offset = 108
+    if reader.read_at(37, 1) == 1:  # Simple item
+        return (reader.offset + 7) // 8
+    code = int_to_chars(reader.read_at(76, 32), 4, 8)
+    item_class = item_data.item_type_classes[item_data.get_item_data(code).type]
+
+    num_filled_sockets = reader.read(3)
+    reader.skip(32 + 7)  # identifier and level
+    quality = reader.read(4)
+    if reader.read(1) == 1:  # has_multiple_pictures
+        reader.skip(3)
+    if reader.read(1) == 1:  # is_class_specific
+        reader.skip(11)
+    if quality in (ItemQuality.LOW_QUALITY, ItemQuality.HIGH_QUALITY):
+        reader.skip(3)
+    elif quality == ItemQuality.MAGIC:
+        reader.skip(22)
+    elif quality in (ItemQuality.SET, ItemQuality.UNIQUE):
+        reader.skip(12)
+    elif quality in (ItemQuality.RARE, ItemQuality.CRAFTED):
+        reader.skip(16)
+        for _ in range(6):
+            if reader.read(1) == 1:
+                reader.skip(11)
+    is_runeword = reader.read_at(42, 1)
+    if is_runeword == 1:
+        reader.skip(16)
+    if reader.read_at(40, 1) == 1:  # is_personalized
+        reader.read_chars(15, 7)
+    if code in item_data.tome_codes:
+        reader.skip(5)
+    reader.skip(1)  # timestamp
+    if item_class & (ItemClass.ARMOR | ItemClass.SHIELD):
+        reader.skip(11)  # defense
+    if item_class & (ItemClass.ARMOR | ItemClass.SHIELD | ItemClass.WEAPON):
+        if reader.read(8) > 0:  # max_durability
+            reader.skip(9)
+    if code in item_data.stackable_codes:
+        reader.skip(9)
+    if reader.read_at(27, 1) == 1:  # has_sockets
+        reader.skip(4)
+    set_list_count = 0
+    if quality == ItemQuality.SET:
+        set_list_count = item_data.get_set_list_count(reader.read(5))
+    reader.skip_magic_properties()
+    for _ in range(set_list_count):
+        reader.skip_magic_properties()
+    if is_runeword == 1:
+        reader.skip_magic_properties()
+
+    end = (reader.offset + 7) // 8
+    for _ in range(num_filled_sockets):
+        end += get_item_length(data[end:])
+    return end
+
+
+def get_code_value(code):
+    # Return the value of the 32 bit code field of an item with the given 3-letter code
+    return int.from_bytes((code[:3] + ' ').encode('ascii'), byteorder='little')
+
+
+def get_value_memory_size(value):
+    # Approximate number of bytes of a decoded item value, recursing into lists and dicts. Enum members, None and small
+    # ints are singletons shared by all items and therefore not counted.
+    if isinstance(value, Enum) or value is None or isinstance(value, int) and -5 <= value <= 256:
+        return 0
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(get_value_memory_size(k) + get_value_memory_size(v) for k, v in value.items())
+    elif isinstance(value, list):
+        size += sum(get_value_memory_size(v) for v in value)
+    return size
+
+
+def translate_lazily(name):
+    # Return a function setting translated_<name> of an item from its attribute <name>
+    def translate(item):
+        setattr(item, 'translated_' + name, item.translate_properties(getattr(item, name)))
+    return translate
+
+
+# Attributes which are not decoded in Item.__init__, and the function decoding them on first access. A run which does
+# not group or sort by properties never decodes any property bits.
+lazy_attributes = {
+    'magic_properties': Item.decode_properties,
+    'set_properties': Item.decode_properties,
+    'runeword_properties': Item.decode_properties,
+    'socketable_properties': Item.merge_all_properties,
+    'all_properties': Item.merge_all_properties,
+    'translated_magic_properties': translate_lazily('magic_properties'),
+    'translated_set_properties': translate_lazily('set_properties'),
+    'translated_runeword_properties': translate_lazily('runeword_properties'),
+    'translated_socketable_properties': translate_lazily('socketable_properties'),
+    'translated_all_properties': translate_lazily('all_properties'),
+}
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+from item import Item
+
+# Increase whenever the decoded item fields change, so that caches written by older versions are discarded
+CACHE_VERSION = 1
+
+
+def get_digest(stash_data, start, end):
+    # Hash the item bytes in range (start, end) with the position bits (65-72) masked out, as those are the only bits
+    # which change when an unchanged item is moved to another place in the stash
+    header = bytearray(stash_data[start: start + 10])
+    header[8] &= 0x01
+    if len(header) > 9:
+        header[9] &= 0xFE
+    digest = hashlib.blake2b(header, digest_size=16)
+    digest.update(stash_data[start + 10: end])
+    return digest.digest()
+
+
+def get_fields(item):
+    # Return the attributes of a freshly decoded item (and its socketed items) without its data
+    fields = {}
+    for name in Item.__slots__:
+        if name == 'data':
+            continue
+        try:
+            value = object.__getattribute__(item, name)
+        except AttributeError:
+            continue
+        if name == 'socketables':
+            value = [(len(socketable.data), get_fields(socketable)) for socketable in value]
+        fields[name] = value
+    return fields
+
+
+def restore_item(data, fields):
+    # Create an item from its data and the attributes stored by get_fields, without decoding anything
+    item = Item.__new__(Item)
+    for name, value in fields.items():
+        if name == 'socketables':
+            socketables = []
+            end = fields['length']
+            for length, socketable_fields in value:
+                socketables.append(restore_item(data[end: end + length], socketable_fields))
+                end += length
+            value = socketables
+        setattr(item, name, value)
+    item.data = data
+    return item
+
+
+class ItemCache:
+    # Cache of decoded items, persisted to a file between runs. Items are looked up by the hash of their bytes (up to
+    # the next b'JM'/b'ST', as the length of an item is only known after decoding it) with the position bits masked
+    # out. Entries hold the total length of the item, the hash of all of its bytes and its decoded attributes. Once
+    # more than max_entries items are cached, the least recently used ones are evicted.
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(path, "rb") as f:
+                version, entries = pickle.load(f)
+            if version == CACHE_VERSION and isinstance(entries, OrderedDict):
+                self.entries = entries
+        except Exception:
+            pass  # No usable cache yet, or a stale or corrupt one. The cache is optional, so start with an empty one.
+
+    def get_item(self, stash_data, start, chunk_end):
+        # Return the cached item starting at start, or None. chunk_end is the position of the next b'JM'/b'ST'.
+        key = get_digest(stash_data, start, chunk_end)
+        entry = self.entries.get(key)
+        if entry is not None:
+            length, digest, fields = entry
+            end = start + length
+            if end == chunk_end or (end <= len(stash_data) and get_digest(stash_data, start, end) == digest):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return restore_item(memoryview(stash_data)[start: end], fields)
+        self.misses += 1
+        return None
+
+    def add_item(self, stash_data, start, chunk_end, item):
+        # Add a freshly decoded item starting at start to the cache
+        end = start + len(item.data)
+        key = get_digest(stash_data, start, chunk_end)
+        digest = key if end == chunk_end else get_digest(stash_data, start, end)
+        self.entries[key] = (len(item.data), digest, get_fields(item))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        # Write the cache file, replacing the old one only once it has been written completely
+        with open(self.path + ".tmp", "wb") as f:
+            pickle.dump((CACHE_VERSION, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + ".tmp", self.path)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -1,5 +1,5 @@
-from enum import IntEnum
-from typing import Dict
+from enum import IntEnum, IntFlag
+from typing import Dict, Tuple
 
 
 class ItemVersion(IntEnum):
@@ -733,56 +733,90 @@ item_data: Dict[str, ItemTypeData] = {
 }
 
 gems_types = [ItemType.GEM_AMETHYST, ItemType.GEM_DIAMOND, ItemType.GEM_EMERALD, ItemType.GEM_RUBY, ItemType.GEM_SAPPHIRE, ItemType.GEM_TOPAZ, ItemType.GEM_SKULL]
-rune_codes = ['r01', 'r02', 'r03', 'r04', 'r05', 'r06', 'r07', 'r08', 'r09', 'r10',
-              'r11', 'r12', 'r13', 'r14', 'r15', 'r16', 'r17', 'r18', 'r19', 'r20',
-              'r21', 'r22', 'r23', 'r24', 'r25', 'r26', 'r27', 'r28', 'r29', 'r30',
-              'r31', 'r32', 'r33']
+
+
+class ItemClass(IntFlag):
+    ARMOR = 1
+    SHIELD = 2
+    WEAPON = 4
+    STACKABLE = 8
+    GEM = 16
+
+
+armor_types = [ItemType.BARB, ItemType.BELT, ItemType.BODY, ItemType.BOOTS, ItemType.CIRCLET, ItemType.GLOVES, ItemType.HELM,
+               ItemType.PELT]
+shield_types = [ItemType.NEC, ItemType.PAL, ItemType.SHIELD]
+weapon_types = [ItemType.AMA, ItemType.ASN, ItemType.AXE, ItemType.BOW, ItemType.DAGGER, ItemType.JAV, ItemType.MACE,
+                ItemType.POLEARM, ItemType.SCEPTER, ItemType.SORC, ItemType.SPEAR, ItemType.STAFF, ItemType.SWORD,
+                ItemType.THROW, ItemType.WAND, ItemType.XBOW]
+stackable_types = [ItemType.THROW, ItemType.THROWPOT, ItemType.JAV]
+
+def get_item_type_classes():
+    # Return the classes of every item type as bit flags
+    item_type_classes = {item_type: ItemClass(0) for item_type in ItemType}
+    for class_types, item_class in ((armor_types, ItemClass.ARMOR), (shield_types, ItemClass.SHIELD),
+                                    (weapon_types, ItemClass.WEAPON), (stackable_types, ItemClass.STACKABLE),
+                                    (gems_types, ItemClass.GEM)):
+        for item_type in class_types:
+            item_type_classes[item_type] |= item_class
+    return item_type_classes
+
+
+# Classes of every item type as bit flags, so checking whether an item belongs to a class is a single lookup
+item_type_classes: Dict[ItemType, ItemClass] = get_item_type_classes()
+
+tome_codes = frozenset(["tkb", "ibk"])
+# Codes of all stackable items: the ones of a stackable type, arrows, bolts, keys and tomes
+stackable_codes = frozenset([code for code, data in item_data.items() if item_type_classes[data.type] & ItemClass.STACKABLE] +
+                            ["am5", "ama", "amf", "key", "aqv", "cqv"]) | tome_codes
 
 
 def get_rune_upgrade_recipe(rune_code):
     return rune_upgrade_recipes[rune_code]
 
 
-class RuneUpgradeRecipe:
-    def __init__(self, amount, gem_code, next_rune_code):
+class CubeRecipe:
+    # Cubing amount items of code (and one catalyst_code item, if not None) gives one next_code item
+    def __init__(self, amount, code, next_code, catalyst_code=None):
         self.amount = amount
-        self.gem_code = gem_code
-        self.next_rune_code = next_rune_code
-
-
-rune_upgrade_recipes: Dict[str, RuneUpgradeRecipe] = {
-    'r01': RuneUpgradeRecipe(3, None, 'r02'),
-    'r02': RuneUpgradeRecipe(3, None, 'r03'),
-    'r03': RuneUpgradeRecipe(3, None, 'r04'),
-    'r04': RuneUpgradeRecipe(3, None, 'r05'),
-    'r05': RuneUpgradeRecipe(3, None, 'r06'),
-    'r06': RuneUpgradeRecipe(3, None, 'r07'),
-    'r07': RuneUpgradeRecipe(3, None, 'r08'),
-    'r08': RuneUpgradeRecipe(3, None, 'r09'),
-    'r09': RuneUpgradeRecipe(3, None, 'r10'),
-    'r10': RuneUpgradeRecipe(3, 'gcy', 'r11'),
-    'r11': RuneUpgradeRecipe(3, 'gcv', 'r12'),
-    'r12': RuneUpgradeRecipe(3, 'gcb', 'r13'),
-    'r13': RuneUpgradeRecipe(3, 'gcr', 'r14'),
-    'r14': RuneUpgradeRecipe(3, 'gcg', 'r15'),
-    'r15': RuneUpgradeRecipe(3, 'gcw', 'r16'),
-    'r16': RuneUpgradeRecipe(3, 'gfy', 'r17'),
-    'r17': RuneUpgradeRecipe(3, 'gfv', 'r18'),
-    'r18': RuneUpgradeRecipe(3, 'gfb', 'r19'),
-    'r19': RuneUpgradeRecipe(3, 'gfr', 'r20'),
-    'r20': RuneUpgradeRecipe(3, 'gfg', 'r21'),
-    'r21': RuneUpgradeRecipe(2, 'gfw', 'r22'),
-    'r22': RuneUpgradeRecipe(2, 'gsy', 'r23'),
-    'r23': RuneUpgradeRecipe(2, 'gsv', 'r24'),
-    'r24': RuneUpgradeRecipe(2, 'gsb', 'r25'),
-    'r25': RuneUpgradeRecipe(2, 'gsr', 'r26'),
-    'r26': RuneUpgradeRecipe(2, 'gsg', 'r27'),
-    'r27': RuneUpgradeRecipe(2, 'gsw', 'r28'),
-    'r28': RuneUpgradeRecipe(2, 'gly', 'r29'),
-    'r29': RuneUpgradeRecipe(2, 'gzv', 'r30'),
-    'r30': RuneUpgradeRecipe(2, 'glb', 'r31'),
-    'r31': RuneUpgradeRecipe(2, 'glr', 'r32'),
-    'r32': RuneUpgradeRecipe(2, 'glg', 'r32')
+        self.code = code
+        self.next_code = next_code
+        self.catalyst_code = catalyst_code
+
+
+rune_upgrade_recipes: Dict[str, CubeRecipe] = {
+    'r01': CubeRecipe(3, 'r01', 'r02'),
+    'r02': CubeRecipe(3, 'r02', 'r03'),
+    'r03': CubeRecipe(3, 'r03', 'r04'),
+    'r04': CubeRecipe(3, 'r04', 'r05'),
+    'r05': CubeRecipe(3, 'r05', 'r06'),
+    'r06': CubeRecipe(3, 'r06', 'r07'),
+    'r07': CubeRecipe(3, 'r07', 'r08'),
+    'r08': CubeRecipe(3, 'r08', 'r09'),
+    'r09': CubeRecipe(3, 'r09', 'r10'),
+    'r10': CubeRecipe(3, 'r10', 'r11', 'gcy'),
+    'r11': CubeRecipe(3, 'r11', 'r12', 'gcv'),
+    'r12': CubeRecipe(3, 'r12', 'r13', 'gcb'),
+    'r13': CubeRecipe(3, 'r13', 'r14', 'gcr'),
+    'r14': CubeRecipe(3, 'r14', 'r15', 'gcg'),
+    'r15': CubeRecipe(3, 'r15', 'r16', 'gcw'),
+    'r16': CubeRecipe(3, 'r16', 'r17', 'gfy'),
+    'r17': CubeRecipe(3, 'r17', 'r18', 'gfv'),
+    'r18': CubeRecipe(3, 'r18', 'r19', 'gfb'),
+    'r19': CubeRecipe(3, 'r19', 'r20', 'gfr'),
+    'r20': CubeRecipe(3, 'r20', 'r21', 'gfg'),
+    'r21': CubeRecipe(2, 'r21', 'r22', 'gfw'),
+    'r22': CubeRecipe(2, 'r22', 'r23', 'gsy'),
+    'r23': CubeRecipe(2, 'r23', 'r24', 'gsv'),
+    'r24': CubeRecipe(2, 'r24', 'r25', 'gsb'),
+    'r25': CubeRecipe(2, 'r25', 'r26', 'gsr'),
+    'r26': CubeRecipe(2, 'r26', 'r27', 'gsg'),
+    'r27': CubeRecipe(2, 'r27', 'r28', 'gsw'),
+    'r28': CubeRecipe(2, 'r28', 'r29', 'gly'),
+    'r29': CubeRecipe(2, 'r29', 'r30', 'gzv'),
+    'r30': CubeRecipe(2, 'r30', 'r31', 'glb'),
+    'r31': CubeRecipe(2, 'r31', 'r32', 'glr'),
+    'r32': CubeRecipe(2, 'r32', 'r32', 'glg')
 }
 
 
@@ -840,12 +874,37 @@ gem_data_list = [
 ]
 
 
+gem_data_by_code: Dict[str, GemData] = {gem_data.code: gem_data for gem_data in gem_data_list}
+gem_data_by_type_and_quality: Dict[Tuple[ItemType, GemQuality], GemData] = {
+    (gem_data.type, gem_data.quality): gem_data for gem_data in gem_data_list
+}
+
+
 def get_gem_data_by_code(item_code):
-    return next(filter(lambda gem: gem.code == item_code, gem_data_list), None)
+    return gem_data_by_code.get(item_code)
 
 
 def get_gem_data_by_type_and_quality(gem_type, quality):
-    return next(filter(lambda gem_data: gem_data.type == gem_type and gem_data.quality == quality, gem_data_list), None)
+    return gem_data_by_type_and_quality.get((gem_type, quality))
+
+
+def get_gem_upgrade_recipe(gem_type, quality):
+    return gem_upgrade_recipes[get_gem_data_by_type_and_quality(gem_type, quality).code]
+
+
+def get_potion_upgrade_recipe(potion_code):
+    return potion_upgrade_recipes[potion_code]
+
+
+potion_upgrade_recipes: Dict[str, CubeRecipe] = {
+    'rvs': CubeRecipe(3, 'rvs', 'rvl')
+}
+
+# Three gems of every quality but perfect give one gem of the next quality
+gem_upgrade_recipes: Dict[str, CubeRecipe] = {
+    gem_data.code: CubeRecipe(3, gem_data.code, get_gem_data_by_type_and_quality(gem_data.type, gem_data.quality + 1).code)
+    for gem_data in gem_data_list if gem_data.quality != GemQuality.PERFECT
+}
 
 
 def get_set_data(set_id):
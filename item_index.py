@@ -0,0 +1,28 @@
+from collections import deque
+
+
+class ItemIndex:
+    # Multiset of items by their item code. The items of each code are kept in the order in which they were added, so
+    # taking the first or last one of them does not have to go over all items.
+    def __init__(self):
+        self.items_by_code = {}
+
+    def add(self, item):
+        if item.code not in self.items_by_code:
+            self.items_by_code[item.code] = deque()
+        self.items_by_code[item.code].append(item)
+
+    def pop_first(self, code):
+        # Remove and return the item of the code which was added first
+        return self.items_by_code[code].popleft()
+
+    def pop_last(self, code):
+        # Remove and return the item of the code which was added last
+        return self.items_by_code[code].pop()
+
+    def get_items(self, codes):
+        # Return the items of the given codes, by code and in the order in which they were added
+        items = []
+        for code in codes:
+            items.extend(self.items_by_code.get(code, ()))
+        return items
@@ -1,39 +1,59 @@
 import configparser
+import mmap
+import os
 import struct
 import tkinter as tk
 from collections import OrderedDict
-from copy import copy
 from shutil import copy
 from tkinter import filedialog
 
-from bit_utils import find_next_null, write_bits, get_data_chunks
-from item import Item
-from item_data import ItemType, ItemQuality, GemQuality, get_gem_data_by_code, get_gem_data_by_type_and_quality, gems_types, rune_codes, get_rune_upgrade_recipe
+from bit_utils import find_next_null, read_bits, write_bits
+from grouping import GroupingPlan
+from incremental import get_group_key, get_page_group_keys, get_page_marker, insert_new_items
+from item import Item, get_item_length
+from item_cache import ItemCache
+from item_data import ItemType, GemQuality, CubeRecipe, get_gem_upgrade_recipe, get_potion_upgrade_recipe, \
+    get_rune_upgrade_recipe
+from packing import pack, get_area_lower_bound, merge_pages
 from page import Page
+from upgrade_plan import UpgradePlan, parse_cube_recipe
 
 root = tk.Tk()
 root.withdraw()
 
 
-def read_stash_file(file_path):
-    # Read stash file and return header, stash version, shared gold (if applicable), number of pages and the rest of
-    # the stash data
+def read_stash_file(file_path, use_mmap=False):
+    # Read stash file and return header, stash version, shared gold (if applicable), number of pages, the stash file data
+    # and the position at which the stash pages start in it. With use_mmap the file is memory mapped instead of read
+    # into memory, so the parts of the stash which are only passed through are never copied.
     with open(file_path, "rb") as f:
-        header = f.read(4)
-        ver = f.read(2)
-        gold = None
+        if use_mmap:
+            stash_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            stash_data = f.read(-1)
 
-        # There is some difference between versions and shared/personal stash files here. If the stash is a shared stash
-        # ("SSS\0") and the version is 02, we need to read 4 bytes into shared gold. If the stash is a personal stash
-        # ("CSTM") then we need to read 4 unused junk bytes. Otherwise, skip.
-        if header == b'SSS\x00' and ver == b'02':
-            gold = f.read(4)
-        if header == b'CSTM':
-            f.read(4)
+    header = stash_data[0:4]
+    ver = stash_data[4:6]
+    gold = None
+    ptr = 6
+
+    # There is some difference between versions and shared/personal stash files here. If the stash is a shared stash
+    # ("SSS\0") and the version is 02, we need to read 4 bytes into shared gold. If the stash is a personal stash
+    # ("CSTM") then we need to read 4 unused junk bytes. Otherwise, skip.
+    if header == b'SSS\x00' and ver == b'02':
+        gold = stash_data[ptr: ptr + 4]
+        ptr += 4
+    if header == b'CSTM':
+        ptr += 4
+
+    num_pages = struct.unpack('I', stash_data[ptr: ptr + 4])[0]
+    return header, ver, gold, num_pages, stash_data, ptr + 4
 
-        num_pages = struct.unpack('I', f.read(4))[0]
-        stash_data = f.read(-1)
-    return header, ver, gold, num_pages, stash_data
+
+def close_stash_file(stash_data):
+    # Release the memory map of a stash file read with use_mmap, so the file can be replaced
+    if isinstance(stash_data, mmap.mmap):
+        stash_data.close()
 
 
 def get_flags(stash_data, ptr):
@@ -50,57 +70,171 @@ def get_page_name(stash_data, ptr):
     return stash_data[ptr: next_null], next_null + 1
 
 
-def chunks_unify_sockets(chunks):
-    # For each chunk of data (separated by JM), check the bits to see how many socketed items the item contains
-    # If an item contains X filled sockets, then append the next X chunks to it and skip forward
-    new_chunks = []
-    while chunks:
-        item_candidate = chunks.pop(0)
-        socketed_items = Item(data=item_candidate).num_filled_sockets
-        for _ in range(socketed_items):
-            item_candidate += chunks.pop(0)
-        new_chunks.append(item_candidate)
-    return new_chunks
-
-
-def get_items(page_data, ptr):
-    # Get list of items, paying attention to socketed items
-    item_data = page_data[ptr:]
-    # Get all "chunks" separated by "JM", then unify chunks by considering whether an item is actually a part of
-    # (socketed in) the previous item
-    chunks = get_data_chunks(item_data, b'JM')[1:]
-    items = chunks_unify_sockets(chunks)
-    return items
-
-
-def get_pages(stash_data):
-    # Return stash page data
-    return get_data_chunks(stash_data, b'ST')
+def get_page_names(stash_data, stash_pages):
+    # Return the names of the stash pages, given as (start, end, item_records) records
+    page_names = []
+    for start, _, _ in stash_pages:
+        _, ptr = get_flags(stash_data, start + 2)
+        page_names.append(get_page_name(stash_data, ptr)[0])
+    return page_names
+
+
+def find_next_boundary(stash_data, start):
+    # Return the position of the next b'JM' or b'ST' after start, i.e. where the next item or page would begin if the
+    # stash data was split on these markers
+    candidates = [pos for pos in (stash_data.find(b'JM', start), stash_data.find(b'ST', start)) if pos != -1]
+    return min(candidates) if candidates else len(stash_data)
+
+
+def is_boundary(stash_data, ptr):
+    # Check if ptr is a position where an item (b'JM') or page (b'ST') starts, or the end of the stash
+    return ptr == len(stash_data) or stash_data[ptr: ptr + 2] in (b'JM', b'ST')
+
+
+def get_num_filled_sockets(stash_data, ptr):
+    # Read the number of filled sockets of the item starting at ptr from its header bits, without decoding the item
+    if read_bits(stash_data, ptr * 8 + 32, 1) == 1 or read_bits(stash_data, ptr * 8 + 37, 1) == 1:  # Ear or simple item
+        return 0
+    return read_bits(stash_data, ptr * 8 + 108, 3)
+
+
+def get_item_record(stash_data, ptr, item_cache=None):
+    # Return the (start, end, item) record of the item starting at ptr, with item being the decoded Item. The items in
+    # its sockets are decoded along with it and attached as item.socketables, so every physical item is decoded once.
+    # The end comes from the decoded item lengths. Only if the item can't be decoded or does not end on an item/page
+    # boundary, fall back to splitting on b'JM'/b'ST' and decode the item from that range, keeping all of its bytes. If
+    # the item can't be decoded from that range either, item is None.
+    # If an item_cache is given, items which are in it are not decoded at all and new items are added to it.
+    stash_view = memoryview(stash_data)
+    chunk_end = find_next_boundary(stash_data, ptr + 2)
+    if item_cache is not None:
+        item = item_cache.get_item(stash_data, ptr, chunk_end)
+        if item is not None:
+            return ptr, ptr + len(item.data), item
+    try:
+        item = Item(stash_view[ptr:])
+        end = ptr + len(item.data)
+        if is_boundary(stash_data, end):
+            if item_cache is not None:
+                item_cache.add_item(stash_data, ptr, chunk_end, item)
+            return ptr, end, item
+    except (AttributeError, IndexError, KeyError, ValueError):
+        pass
+    end, socket_starts = split_item(stash_data, ptr)
+    try:
+        return ptr, end, Item(stash_view[ptr:end], socket_starts)
+    except (AttributeError, IndexError, KeyError, ValueError):
+        return ptr, end, None
+
+
+def split_item(stash_data, ptr):
+    # Return the end of the item starting at ptr and the offsets (relative to ptr) of the items in its sockets, splitting
+    # on b'JM'/b'ST' markers
+    end = find_next_boundary(stash_data, ptr + 2)
+    socket_starts = []
+    for _ in range(get_num_filled_sockets(stash_data, ptr)):
+        socket_starts.append(end - ptr)
+        end = find_next_boundary(stash_data, end + 2)
+    return end, socket_starts
+
+
+def get_item_end(stash_data, ptr):
+    # Return the end of the item starting at ptr like get_item_record, but without decoding the item. Only its length
+    # is decoded, see item.get_item_length.
+    try:
+        end = ptr + get_item_length(memoryview(stash_data)[ptr:])
+        if is_boundary(stash_data, end):
+            return end
+    except (AttributeError, IndexError, KeyError, ValueError):
+        pass
+    return split_item(stash_data, ptr)[0]
+
+
+def tokenize_stash(stash_data, ptr=0, item_cache=None, num_pages_to_skip=0):
+    # Walk the stash data from ptr once and return a (start, end, item_records) record for every page, with item_records
+    # as returned by get_item_record. Page and item boundaries are taken from the page headers, the item counts and the
+    # decoded item lengths, so item data that happens to contain b'JM' or b'ST' does not split an item.
+    # Every page has to start with b'ST' and its item list with b'JM', otherwise the decoded lengths can't be trusted.
+    # The items of the first num_pages_to_skip pages are not decoded (and not cached), only their lengths, and
+    # item_records is None for these pages.
+    pages = []
+    while ptr < len(stash_data):
+        page_start = ptr
+        if stash_data[ptr: ptr + 2] != b'ST':
+            raise ValueError("No stash page at offset %d" % ptr)
+        flags, ptr = get_flags(stash_data, ptr + 2)  # Skip b'ST', get page flags and advance pointer
+        stash_page_name, ptr = get_page_name(stash_data, ptr)  # Get page name and advance pointer
+        if stash_data[ptr: ptr + 2] != b'JM':
+            raise ValueError("No item list at offset %d" % ptr)
+        num_items = read_bits(stash_data, (ptr + 2) * 8, 16)  # Item list header: b'JM' and 2 bytes item count
+        ptr += 4
+        if len(pages) < num_pages_to_skip:
+            for _ in range(num_items):
+                ptr = get_item_end(stash_data, ptr)
+            pages.append((page_start, ptr, None))
+            continue
+        item_records = []
+        for _ in range(num_items):
+            item_records.append(get_item_record(stash_data, ptr, item_cache))
+            ptr = item_records[-1][1]
+        pages.append((page_start, ptr, item_records))
+    return pages
 
 
-def parse_stash_data(stash_data, config):
-    # Retrieve the pages we do not wish to sort, and parse the list of items in the remaining pages
-    stash_pages = get_pages(stash_data)
+def parse_stash_pages(stash_data, config, ptr=0, item_cache=None):
+    # Retrieve the pages (starting at ptr) we do not wish to sort, and the (start, end, item_records) records of the
+    # remaining pages as returned by tokenize_stash
     num_pages_to_ignore = int(config["GENERAL"]["IgnoreFirstXPages"])
+    stash_pages = tokenize_stash(stash_data, ptr, item_cache, num_pages_to_ignore)
+
+    # Pages (and items) are views into stash_data, so nothing is copied until an item is actually modified
+    stash_view = memoryview(stash_data)
 
     # If there are fewer pages total than those we wish to ignore, do nothing except return all pages.
     # Otherwise divide into pages to ignore and pages to parse
     if num_pages_to_ignore >= len(stash_pages):
-        return stash_pages, []
-    pages_to_ignore = stash_pages[0:num_pages_to_ignore]
-    pages_to_parse = stash_pages[num_pages_to_ignore:]
+        return [stash_view[start: end] for start, end, _ in stash_pages], []
+    pages_to_ignore = [stash_view[start: end] for start, end, _ in stash_pages[0:num_pages_to_ignore]]
+
+    # Pages with items which can't be decoded are kept unchanged as well
+    pages_to_parse = []
+    for start, end, item_records in stash_pages[num_pages_to_ignore:]:
+        if any(item is None for _, _, item in item_records):
+            print("Page at offset %d has items which can't be decoded, keeping it unchanged" % start)
+            pages_to_ignore.append(stash_view[start: end])
+        else:
+            pages_to_parse.append((start, end, item_records))
+    return pages_to_ignore, pages_to_parse
+
 
-    # Parse items in remaining pages
+def get_items(stash_pages):
+    # Collect the items (already decoded while tokenizing) of the stash pages
     items = []
-    for page in pages_to_parse:
-        ptr = 2  # Start 2 bytes in
-        flags, ptr = get_flags(page, ptr)  # Get page flags and advance pointer
-        stash_page_name, ptr = get_page_name(page, ptr)  # Get page name and advance pointer
-        page_items = get_items(page, ptr)  # Get items in page
-        for item in page_items:
-            items.append(Item(data=item))  # Initialize an Item instance for each item
+    for _, _, item_records in stash_pages:
+        for _, _, item in item_records:
+            items.append(item)
+    return items
+
 
-    return pages_to_ignore, items
+def parse_stash_data(stash_data, config, ptr=0, item_cache=None):
+    # Retrieve the pages (starting at ptr) we do not wish to sort, and parse the list of items in the remaining pages
+    pages_to_ignore, pages_to_parse = parse_stash_pages(stash_data, config, ptr, item_cache)
+    return pages_to_ignore, get_items(pages_to_parse)
+
+
+def print_memory_usage(item_list):
+    # Print the average memory footprint of the parsed items, split by kind of item
+    sizes = OrderedDict()
+    for item in item_list:
+        if item.is_simple == 1:
+            kind = "simple"
+        elif item.is_runeword == 1:
+            kind = "runeword"
+        else:
+            kind = item.quality.name.lower()
+        sizes.setdefault(kind, []).append(item.get_memory_size())
+    for kind, kind_sizes in sizes.items():
+        print("Memory usage of %s items: %d bytes per item (%d items)" % (kind, sum(kind_sizes) / len(kind_sizes), len(kind_sizes)))
 
 
 def add_to_group(group, item, key=None):
@@ -114,281 +248,114 @@ def add_to_group(group, item, key=None):
             group[key] = [item]
 
 
-def append_supergroup_flat(groups, supergroup):
+def append_supergroup_flat(groups, rule, supergroup):
     # Used to "flatten"/"unify" supergroups (sets, uniques) and then append to groups structure
     flat_group = []
     for item in supergroup:
         flat_group.extend(supergroup[item])
-    groups.append(flat_group)
+    groups.append((rule, flat_group))
 
 
-def append_supergroup(groups, supergroup):
+def append_supergroup(groups, rule, supergroup):
     # Used to append each item in supergroup to groups
     for item in supergroup:
-        groups.append(supergroup[item])
+        groups.append((rule, supergroup[item]))
 
 
-def upgrade_rejuvenation_potions(item_list):
-    # Get potions from item list
-    potion_list = list(filter(lambda item: item.code == 'rvs', item_list))
-
-    # get item list without gems
-    item_list = list(filter(lambda item: item.code != 'rvs', item_list))
-
-    full, normal = divmod(len(potion_list), 3)
-
-    for x in range(full):
-        potion = potion_list[x]
-        potion.set_code('rvl')
-        item_list.append(potion)
-
-    for x in range(normal):
-        potion = potion_list[len(potion_list) - x - 1]
-        item_list.append(potion)
-
-    return item_list
-
-
-def upgrade_gems(item_list, qualities_to_cube, types_to_cube, keep_at_least):
-    # Get gems from item list
-    gem_list = list(filter(lambda item: item.is_gem(), item_list))
-
-    # get item list without gems
-    item_list = list(filter(lambda item: not item.is_gem(), item_list))
-
-    # Initialize a dictionary with keys [gem_type][gem_quality] with empty lists
-    gems = {}
-    for gem_type in gems_types:
-        gems[gem_type] = {}
-        for gem_quality in GemQuality:
-            gems[gem_type][gem_quality] = []
-
-    # Add gems to gem dictionary
-    for gem in gem_list:
-        gems[gem.type][gem.gem_quality].append(gem)
-
-    # Upgrade Gems
-    for gem_type in types_to_cube:
-        for gem_quality in qualities_to_cube:
-            while len(gems[gem_type][gem_quality]) >= (3 + int(keep_at_least)):
-                gems[gem_type][gem_quality].pop()
-                gems[gem_type][gem_quality].pop()
-                g = gems[gem_type][gem_quality].pop()
-                g.gem_quality += 1
-                g.set_code(get_gem_data_by_type_and_quality(gem_type, g.gem_quality).code)
-                gems[gem_type][g.gem_quality].append(g)
-
-    # Turn the dictionary back into a list
-    gem_list = []
-    for gem_type in gems_types:
-        for gem_quality in GemQuality:
-            gem_list.extend(gems[gem_type][gem_quality])
-
-    # Add gems back to item list and return it
-    return item_list + gem_list
-
-
-def upgrade_runes(item_list, runes_to_upgrade, keep_at_least, downgrade_gems, ignore_gems):
-    # Get runes from item list
-    rune_list = list(filter(lambda item: item.type == ItemType.RUNE, item_list))
-
-    # get item list without runes
-    item_list = list(filter(lambda item: item.type != ItemType.RUNE, item_list))
-
-    # Initialize a dictionary with keys [rune_code] with empty lists
-    runes = {}
-    for rune_code in rune_codes:
-        runes[rune_code] = []
-
-    # Add runes to rune dictionary
-    for rune in rune_list:
-        runes[rune.code].append(rune)
-
-    # Upgrade Runes
-    for rune_code in runes_to_upgrade:
-        recipe = get_rune_upgrade_recipe(rune_code)
-        while len(runes[rune_code]) >= (recipe.amount + int(keep_at_least)) and has_gem_for_rune_upgrade(item_list, recipe.gem_code, downgrade_gems, ignore_gems):
-            item_list = remove_gem_for_rune_upgrade(item_list, recipe.gem_code, downgrade_gems, ignore_gems)
-            r = None
-            for _ in range(recipe.amount):
-                r = runes[rune_code].pop()
-            r.set_code(recipe.next_rune_code)
-            runes[recipe.next_rune_code].append(r)
-
-    # Turn the dictionary back into a list
-    rune_list = []
-    for rune_code in rune_codes:
-        rune_list.extend(runes[rune_code])
-
-    # Add runes back to item list and return it
-    return item_list + rune_list
-
-
-def has_gem_for_rune_upgrade(item_list, gem_code, downgrade_gems, ignore_gems):
-    if gem_code is None or ignore_gems == '1':
-        return True
-
-    gem_codes_to_check = get_gem_codes_to_check(gem_code, downgrade_gems)
-    return len(list(filter(lambda item: item.code in gem_codes_to_check, item_list))) > 0
-
-
-def downgrade_gem_to(item_list, gem_code_from, gem_code_to):
-    gem_data_from = get_gem_data_by_code(gem_code_from)
-    while gem_data_from.code != gem_code_to:
-        for item in item_list:
-            if item.code == gem_data_from.code:
-                item_list.remove(item)
-                item.gem_quality -= 1
-                gem_data_from = get_gem_data_by_type_and_quality(item.type, item.gem_quality)
-                item.set_code(gem_data_from.code)
-                for _ in range(3):
-                    item_list.append(copy(item))
-                break
-    return item_list
-
-
-def get_gem_codes_to_check(gem_code, downgrade_gems):
-    gem_codes_to_check = [gem_code]
-    if downgrade_gems == '1':
-        gem_data = get_gem_data_by_code(gem_code)
-        while True:
-            gem_data = get_gem_data_by_type_and_quality(gem_data.type, gem_data.quality + 1)
-            if gem_data is None:
-                break
-            else:
-                gem_codes_to_check.append(gem_data.code)
-    return gem_codes_to_check
-
-
-def remove_gem_for_rune_upgrade(item_list, gem_code, downgrade_gems, ignore_gems):
-    if gem_code is None or ignore_gems == '1':
-        return item_list
-
-    downgrade_needed = False
-    gem_removed = False
-    for gem_code_to_check in get_gem_codes_to_check(gem_code, downgrade_gems):
-        if gem_removed:
-            break
-        for item in item_list:
-            if item.code == gem_code_to_check:
-                if downgrade_needed:
-                    item_list = downgrade_gem_to(item_list, gem_code_to_check, gem_code)
-                    del item_list[-1]
-                else:
-                    item_list.remove(item)
-                gem_removed = True
-                break
-        downgrade_needed = True
-    return item_list
-
-
-def to_groups(item_list, config):
+def to_groups(item_list, grouping_plan):
     # Sort the items into groups. Each group is sorted internally with some criteria, and different groups will never
-    # be on the same stash page.
+    # be on the same stash page. The groups are defined by the GroupingPlan compiled from the settings.
 
     item_groups = OrderedDict()
-    if "ITEM_GROUP_MISC" not in config:
-        config["ITEM_GROUP_MISC"] = {}
-    for section in config:
-        if section.startswith('ITEM_GROUP_'):
-            item_group = section[11:]
-            if 'SubGroupByAttribute' in config[section]:
-                item_groups[item_group] = {}
-            else:
-                item_groups[item_group] = []
+    for rule in grouping_plan.rules:
+        if rule.sub_group_by is not None:
+            item_groups[rule.name] = {}
+        else:
+            item_groups[rule.name] = []
 
     for item in item_list:
-        added = False
-
-        for group in item_groups:
-            add_by_type = "ItemType" not in config["ITEM_GROUP_" + group]
-            add_by_quality = "ItemQuality" not in config["ITEM_GROUP_" + group]
-            add_by_attribute = "Attribute" not in config["ITEM_GROUP_" + group]
-
-            if "ItemType" in config["ITEM_GROUP_" + group]:
-                add_by_type = False
-                types = [x.strip() for x in config["ITEM_GROUP_" + group]["ItemType"].split(',')]
-                for t in types:
-                    if ItemType[t] == item.type:
-                        add_by_type = True
-                        break
-
-            if "ItemQuality" in config["ITEM_GROUP_" + group]:
-                add_by_quality = False
-                qualities = [x.strip() for x in config["ITEM_GROUP_" + group]["ItemQuality"].split(',')]
-                for q in qualities:
-                    if ItemQuality[q] == item.quality:
-                        add_by_quality = True
-                        break
-
-            if "Attribute" in config["ITEM_GROUP_" + group]:
-                add_by_attribute = False
-                attributes = [x.strip() for x in config["ITEM_GROUP_" + group]["Attribute"].split(',')]
-                for a in attributes:
-                    check_against = 1
-                    if a[0] == "!":
-                        check_against = 0
-                        a = a[1:]
-                    if getattr(item, a) == check_against:
-                        add_by_attribute = True
-                        break
-
-            if add_by_type and add_by_quality and add_by_attribute:
-                if "SubGroupByAttribute" in config["ITEM_GROUP_" + group]:
-                    add_to_group(item_groups[group], item, getattr(item, config["ITEM_GROUP_" + group]["SubGroupByAttribute"]))
-                else:
-                    add_to_group(item_groups[group], item)
-                added = True
-                break
-
-        if not added:
-            add_to_group(item_groups["MISC"], item)
-
-    for group in item_groups:
-        sort_by = []
-        if "SortByAttribute" in config["ITEM_GROUP_" + group]:
-            sort_by = [x.strip() for x in config["ITEM_GROUP_" + group]["SortByAttribute"].split(',')]
-
-        if 'SubGroupByAttribute' in config["ITEM_GROUP_" + group]:
-            for sub_group in item_groups[group]:
-                item_groups[group][sub_group].sort(key=lambda x: [getattr(x, attr, "code") for attr in sort_by])
-
-            sort_sub_groups_by = [config["ITEM_GROUP_" + group]["SubGroupByAttribute"]]
-            if "SortSubGroupsByAttribute" in config["ITEM_GROUP_" + group]:
-                sort_sub_groups_by = [x.strip() for x in config["ITEM_GROUP_" + group]["SortSubGroupsByAttribute"].split(',')]
-            item_groups[group] = OrderedDict(sorted(item_groups[group].items(), key=lambda x: [getattr(x[1][0], attr, "code") for attr in sort_sub_groups_by]))
+        rule = grouping_plan.get_rule(item)
+        if rule.sub_group_by is not None:
+            add_to_group(item_groups[rule.name], item, getattr(item, rule.sub_group_by))
         else:
-            item_groups[group].sort(key=lambda x: [getattr(x, attr, "code") for attr in sort_by])
+            add_to_group(item_groups[rule.name], item)
 
-    # Finally, add all sorted groups to the groups list. The ordering here is what will determine the actual order in
-    # the stash, so modify to your taste.
+    for rule in grouping_plan.rules:
+        item_groups[rule.name] = rule.sort_group(item_groups[rule.name])
+
+    # Finally, add all sorted groups to the groups list as (rule, items). The ordering here is what will determine the
+    # actual order in the stash, so modify to your taste.
     groups = []
-    for key in item_groups:
-        if isinstance(item_groups[key], dict):
-            append_supergroup(groups, item_groups[key])
+    for rule in grouping_plan.rules:
+        if isinstance(item_groups[rule.name], dict):
+            append_supergroup(groups, rule, item_groups[rule.name])
         else:
-            groups.append(item_groups[key])
+            groups.append((rule, item_groups[rule.name]))
 
     # Finally, remove any empty groups to avoid having empty stash pages
-    groups = [group for group in groups if group]
+    groups = [(rule, group) for rule, group in groups if group]
 
     return groups
 
 
-def to_pages(groups):
-    # Take the ordered item groups and put them into virtual stash pages
+def to_pages(groups, merge_small_groups=False, gap=1):
+    # Take the ordered item groups and put them into virtual stash pages. Each group gets its own pages, which are
+    # filled according to the packing strategy of its rule. If merge_small_groups is set, consecutive groups which fit
+    # onto a single page share pages, each group starting gap columns to the right of the previous one.
     pages = []  # List of stash pages
-    for group in groups:
-        current_page = Page()  # For each group, create a new stash page
-        for item in group:  # Then for each item, attempt to insert it somewhere in the page
-            if item.num_filled_sockets > 0:
-                print(item.to_json())
-            if not current_page.insert_item(item):  # If insertion fails, add current page to list of "ready" stash
-                # pages, create a new page, and insert item into the new page
-                pages.append(current_page)
-                current_page = Page()
-                current_page.insert_item(item)
-        pages.append(current_page)  # When done, add current page to list of "ready" stash
+    lower_bound = 0
+    shared_page = None  # Page of the previous group if it was a small one
+    for rule, group in groups:
+        group_pages = pack(group, rule.packing_strategy, rule.packing_time_limit)
+        lower_bound += get_area_lower_bound(group)
+        if merge_small_groups and len(group_pages) == 1:
+            if shared_page is not None and merge_pages(shared_page, group_pages[0], gap):
+                continue
+            shared_page = group_pages[0]
+        else:
+            shared_page = None
+        pages.extend(group_pages)
+    if merge_small_groups:
+        lower_bound = get_area_lower_bound([item for _, group in groups for item in group])
+    print("Packing: %d pages (at least %d pages needed by item area)" % (len(pages), lower_bound))
+    return pages
+
+
+def to_stable_pages(groups, stash_pages, grouping_plan):
+    # Like to_pages, but items stay where they are if the page they are on belongs to their group (see
+    # incremental.get_page_group_keys). Each of these pages becomes a page of the group, holding the items which stay.
+    # Only the other items of the group, and all items of pages which belong to no group, are moved, into the free space
+    # of these pages or onto new pages.
+    home_pages = {}  # Items of each group on the pages belonging to it, by group key
+    for _, _, item_records in stash_pages:
+        if item_records:
+            keys, key = get_page_group_keys(grouping_plan, item_records)
+            if key is None:
+                continue
+            home_pages.setdefault(key, []).append([item for item_key, (_, _, item) in zip(keys, item_records) if item_key == key])
+
+    pages = []  # List of stash pages
+    num_moved = 0
+    num_items = 0
+    for rule, group in groups:
+        group_items = set(map(id, group))  # Items may have been removed from the stash by the upgrades
+        group_pages = []
+        staying = set()
+        for page_items in home_pages.get(get_group_key(grouping_plan, group[0]), []):
+            page = Page()
+            for item in page_items:
+                if id(item) in group_items and page.place_item(item):
+                    staying.add(id(item))
+            if page.items:
+                group_pages.append(page)
+        moved = [item for item in group if id(item) not in staying]
+        moved = [item for item in moved if not any(page.insert_item(item) for page in group_pages)]
+        if moved:
+            group_pages.extend(pack(moved, rule.packing_strategy, rule.packing_time_limit))
+        pages.extend(group_pages)
+        num_moved += len(group) - len(staying)
+        num_items += len(group)
+    print("Stable layout: %d pages, %d of %d items moved" % (len(pages), num_moved, num_items))
     return pages
 
 
@@ -416,12 +383,17 @@ def make_stash(path, header, ver, gold, new_pages, ignored_pages):
         # For the new pages, first write the header and flags, then the number of items,
         # and then each individual item.
         for page in new_pages:
+            if page.data is not None:  # Pages left unchanged are written back as they were
+                f.write(page.data)
+                continue
+            # The page is named by its marker, so an incremental organize can tell which items were put there
+            marker = get_page_marker(item.data for item in page.items)
             if header == b'SSS\x00':  # For shared stashes, turn on the shared stash page flag
-                f.write(b'ST\x01\x00\x00\x00\x00JM')
+                f.write(b'ST\x01\x00\x00\x00' + marker + b'\x00JM')
             if header == b'CSTM':  # For personal stashes, keep all flags turned off
-                f.write(b'ST\x00\x00\x00\x00\x00JM')
+                f.write(b'ST\x00\x00\x00\x00' + marker + b'\x00JM')
             # IF USING OLDER VERSIONS OF PLUGY, COMMENT OR DELETE THE 4 LINES ABOVE AND UNCOMMENT THE LINE BELOW
-            # f.write(b'ST\x00JM')
+            # f.write(b'ST' + marker + b'\x00JM')
             f.write(write_bits(b'\x00\x00', 0, 16, page.num_items()))
             for item in page.items:
                 f.write(item.data)
@@ -438,6 +410,7 @@ def main():
     # Read config
     config = configparser.ConfigParser()
     config.read("settings.ini")
+    grouping_plan = GroupingPlan(config)  # Compiled first, so errors in the groups show before the stash is read
 
     # Get stash file from user
     stash_file_path = filedialog.askopenfilename(title="Select shared stash file",
@@ -448,32 +421,73 @@ def main():
     backup_stash(stash_file_path, config)
 
     # Read stash file and parse items
-    header, ver, gold, num_pages, stash_data = read_stash_file(stash_file_path)
-    pages_to_ignore, item_list = parse_stash_data(stash_data, config)
-
-    # Upgrade Rejuvenation Potions
-    if (config["GENERAL"]["UpgradeRejuvenationPotions"]) == '1':
-        item_list = upgrade_rejuvenation_potions(item_list)
-
-    # Upgrade runes
-    if (config["UPGRADE_RUNES"]["Enabled"]) == '1':
-        runes_to_upgrade = [x.strip() for x in config["UPGRADE_RUNES"]['UpgradeOnly'].split(',')]
-        item_list = upgrade_runes(item_list, runes_to_upgrade, config["UPGRADE_RUNES"]["KeepAtLeast"], config["UPGRADE_RUNES"]["DowngradeGems"], config["UPGRADE_RUNES"]["IgnoreGems"])
-
-    # Upgrade gems
-    if (config["UPGRADE_GEMS"]["Enabled"]) == '1':
-        qualities_to_cube = [GemQuality[x.strip()] for x in config["UPGRADE_GEMS"]['UpgradeQualitiesOnly'].split(',')]
-        types_to_cube = [ItemType[x.strip()] for x in config["UPGRADE_GEMS"]['UpgradeTypesOnly'].split(',')]
-        item_list = upgrade_gems(item_list, qualities_to_cube, types_to_cube, config["UPGRADE_GEMS"]['KeepAtLeast'])
-
-    # Sort items into different groups, and sort each group
-    groups = to_groups(item_list, config)
-
-    # Create new stash pages and fill them with the sorted items from the groups
-    pages = to_pages(groups)
-
-    # Finally, write all data to a new stash file
-    make_stash(stash_file_path, header, ver, gold, pages, pages_to_ignore)
+    use_mmap = config["GENERAL"].get("MemoryMapStashFile", "0") == '1'
+    header, ver, gold, num_pages, stash_data, ptr = read_stash_file(stash_file_path, use_mmap)
+    item_cache = None
+    if config["GENERAL"].get("ItemCacheFile", ""):
+        item_cache = ItemCache(config["GENERAL"]["ItemCacheFile"], int(config["GENERAL"].get("ItemCacheSize", "100000")))
+    pages_to_ignore, stash_pages = parse_stash_pages(stash_data, config, ptr, item_cache)
+    item_list = get_items(stash_pages)
+    if config["GENERAL"].get("ReportMemoryUsage", "0") == '1':
+        print_memory_usage(item_list)
+
+    # If the stash was already organized before, only insert the new items into it
+    merge_small_groups = config["GENERAL"].get("MergeSmallGroups", "0") == '1'
+    pages = None
+    if config["GENERAL"].get("IncrementalOrganize", "0") == '1' and not merge_small_groups:
+        pages = insert_new_items(stash_data, stash_pages, get_page_names(stash_data, stash_pages), grouping_plan)
+
+    if pages is None:
+        # Plan the cube upgrades of potions, runes, gems and the custom recipes, and apply them to the items
+        upgrade_plan = UpgradePlan(item_list)
+        if (config["GENERAL"]["UpgradeRejuvenationPotions"]) == '1':
+            upgrade_plan.add_recipe(get_potion_upgrade_recipe('rvs'))
+        if (config["UPGRADE_RUNES"]["Enabled"]) == '1':
+            runes_to_upgrade = [x.strip() for x in config["UPGRADE_RUNES"]['UpgradeOnly'].split(',')]
+            for rune_code in runes_to_upgrade:
+                recipe = get_rune_upgrade_recipe(rune_code)
+                if config["UPGRADE_RUNES"]["IgnoreGems"] == '1':
+                    recipe = CubeRecipe(recipe.amount, recipe.code, recipe.next_code)
+                upgrade_plan.add_recipe(recipe, int(config["UPGRADE_RUNES"]["KeepAtLeast"]),
+                                        config["UPGRADE_RUNES"]["DowngradeGems"] == '1')
+        if (config["UPGRADE_GEMS"]["Enabled"]) == '1':
+            qualities_to_cube = [GemQuality[x.strip()] for x in config["UPGRADE_GEMS"]['UpgradeQualitiesOnly'].split(',')]
+            types_to_cube = [ItemType[x.strip()] for x in config["UPGRADE_GEMS"]['UpgradeTypesOnly'].split(',')]
+            for gem_type in types_to_cube:
+                for gem_quality in qualities_to_cube:
+                    upgrade_plan.add_recipe(get_gem_upgrade_recipe(gem_type, gem_quality),
+                                            int(config["UPGRADE_GEMS"]['KeepAtLeast']))
+        if config.has_section("CUBE_RECIPES"):
+            for recipe_text in config["CUBE_RECIPES"].values():
+                upgrade_plan.add_recipe(parse_cube_recipe(recipe_text))
+        upgrade_plan.run()
+        if config["GENERAL"].get("PrintUpgradePlan", "0") == '1':
+            upgrade_plan.print_plan()
+        if config["GENERAL"].get("ExecuteUpgradePlan", "1") == '1':
+            item_list = upgrade_plan.apply(item_list)
+
+        # Sort items into different groups, and sort each group
+        groups = to_groups(item_list, grouping_plan)
+        print("Grouping: %d items, %d unique item signatures" % (len(item_list), len(grouping_plan.rules_by_signature)))
+
+        # Create new stash pages and fill them with the sorted items from the groups
+        if config["GENERAL"].get("StableLayout", "0") == '1':
+            pages = to_stable_pages(groups, stash_pages, grouping_plan)
+        else:
+            pages = to_pages(groups, merge_small_groups, int(config["GENERAL"].get("MergedGroupsGap", "1")))
+        del groups
+
+    # Finally, write all data to a new stash file and replace the old one with it. Ignored pages and unmodified items
+    # still reference the old stash data (which may be memory mapped), so release them before replacing the file.
+    new_stash_file_path = stash_file_path + ".tmp"
+    make_stash(new_stash_file_path, header, ver, gold, pages, pages_to_ignore)
+    del item_list, stash_pages, pages, pages_to_ignore
+    close_stash_file(stash_data)
+    os.replace(new_stash_file_path, stash_file_path)
+
+    if item_cache is not None:
+        item_cache.save()
+        print("Item cache: %d hits, %d misses (hit rate %.1f%%)" % (item_cache.hits, item_cache.misses, item_cache.hit_rate() * 100))
 
 
 if __name__ == "__main__":
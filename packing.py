@@ -0,0 +1,203 @@
+import time
+from collections import deque
+
+from page import Page, PAGE_SIZE, get_shape
+
+FULL_PAGE = (1 << PAGE_SIZE * PAGE_SIZE) - 1
+
+
+def get_area(item):
+    return item.x_size * item.y_size
+
+
+def get_area_lower_bound(items):
+    # The minimum number of pages the items could possibly fit on, ignoring their shapes
+    return -(-sum(get_area(item) for item in items) // (PAGE_SIZE * PAGE_SIZE))
+
+
+def pack_ordered(items, time_limit=None):
+    # Put the items onto pages in their order, closing the current page as soon as an item does not fit on it
+    pages = []
+    current_page = Page()
+    for item in items:  # For each item, attempt to insert it somewhere in the page
+        if not current_page.insert_item(item):  # If insertion fails, add current page to list of "ready" stash
+            # pages, create a new page, and insert item into the new page
+            pages.append(current_page)
+            current_page = Page()
+            current_page.insert_item(item)
+    pages.append(current_page)
+    return pages
+
+
+def sort_by_area(items):
+    # Largest items first. The sort is stable, so items of the same size keep their order within the group.
+    return sorted(items, key=get_area, reverse=True)
+
+
+def pack_first_fit_decreasing(items, time_limit=None):
+    # Put the items (largest first) onto the first page they fit on, keeping all pages of the group open
+    pages = []
+    for item in sort_by_area(items):
+        if not any(page.insert_item(item) for page in pages):
+            pages.append(Page())
+            pages[-1].insert_item(item)
+    return pages
+
+
+def pack_best_fit(items, time_limit=None):
+    # Put the items (largest first) onto the fullest page they fit on, keeping all pages of the group open
+    pages = []
+    for item in sort_by_area(items):
+        for page in sorted(pages, key=Page.free_space):
+            if page.insert_item(item):
+                break
+        else:
+            pages.append(Page())
+            pages[-1].insert_item(item)
+    return pages
+
+
+class ExactPacking:
+    # Branch and bound search for the minimum number of pages the items of a group fit on. Pages are filled one after
+    # another, and on the current page the first free position (going column by column) is either the top left corner
+    # of one of the remaining items or left empty, so every layout is found exactly once. Items of the same size are
+    # interchangeable and only counted per size, and (page occupancy, remaining counts) states which were already
+    # reached with at most as many full pages are not searched again.
+    def __init__(self, items, time_limit):
+        self.sizes = sorted(set((item.x_size, item.y_size) for item in items), key=lambda x: x[0] * x[1], reverse=True)
+        self.shapes = [get_shape(x_size, y_size) for x_size, y_size in self.sizes]
+        self.areas = [x_size * y_size for x_size, y_size in self.sizes]
+        self.counts = tuple(sum(1 for item in items if (item.x_size, item.y_size) == size) for size in self.sizes)
+        self.area = sum(get_area(item) for item in items)
+        self.deadline = time.perf_counter() + time_limit / 1000
+        self.best_num_pages = None
+        self.best_trail = None
+        self.visited = {}
+
+    def search(self, num_pages):
+        # Look for a layout with less than num_pages pages until the whole search space is done or the time is up.
+        # Return the trail of the best layout as (size index, x, y, page index, next) links, or None.
+        self.best_num_pages = num_pages
+        stack = [self.expand(0, 0, self.counts, self.area, None)]
+        num_steps = 0
+        while stack:
+            num_steps += 1
+            if num_steps % 1024 == 0 and time.perf_counter() > self.deadline:
+                break
+            state = next(stack[-1], None)
+            if state is None:
+                stack.pop()
+            else:
+                stack.append(self.expand(*state))
+        return self.best_trail
+
+    def expand(self, num_pages, occupied, counts, area, trail):
+        # Yield the states following the given one, where num_pages pages are full and occupied is the current page
+        if area == 0:
+            self.best_num_pages = num_pages + (occupied != 0)
+            self.best_trail = trail
+            return
+        free = ~occupied & FULL_PAGE
+        lower_bound = num_pages + 1 + max(0, -(-(area - bin(free).count("1")) // (PAGE_SIZE * PAGE_SIZE)))
+        if lower_bound >= self.best_num_pages or self.visited.get((occupied, counts), num_pages + 1) <= num_pages:
+            return
+        self.visited[(occupied, counts)] = num_pages
+        if not free:
+            yield num_pages + 1, 0, counts, area, trail
+            return
+        cell = (free & -free).bit_length() - 1
+        x, y = divmod(cell, PAGE_SIZE)
+        for idx, shape in enumerate(self.shapes):
+            mask = shape.masks.get((x, y))
+            if counts[idx] and mask is not None and not occupied & mask:
+                next_counts = counts[:idx] + (counts[idx] - 1,) + counts[idx + 1:]
+                yield num_pages, occupied | mask, next_counts, area - self.areas[idx], (idx, x, y, num_pages, trail)
+        yield num_pages, occupied | 1 << cell, counts, area, trail
+
+
+def pack_exact(items, time_limit):
+    # Put the items onto as few pages as possible. Start with the first fit decreasing layout and search for a better
+    # one for up to time_limit milliseconds. Items of the same size keep their order within the group.
+    pages = pack_first_fit_decreasing(items)
+    if len(pages) <= get_area_lower_bound(items):
+        return pages
+    packing = ExactPacking(items, time_limit)
+    trail = packing.search(len(pages))
+    if trail is None:
+        return pages
+
+    placements = []
+    while trail is not None:
+        idx, x, y, page_idx, trail = trail
+        placements.append((packing.sizes[idx], x, y, page_idx))
+    items_by_size = {size: deque() for size in packing.sizes}
+    for item in items:
+        items_by_size[(item.x_size, item.y_size)].append(item)
+    pages = [Page() for _ in range(packing.best_num_pages)]
+    for size, x, y, page_idx in reversed(placements):
+        item = items_by_size[size].popleft()
+        item.set_position(x, y)
+        pages[page_idx].items.append(item)
+        pages[page_idx].allocate(x, item.x_size, y, item.y_size)
+    return pages
+
+
+def tiles_page(items):
+    # Check if all items have the same size, and the page is evenly divided into columns and rows of that size
+    x_size, y_size = items[0].x_size, items[0].y_size
+    return PAGE_SIZE % x_size == 0 and PAGE_SIZE % y_size == 0 and \
+        all(item.x_size == x_size and item.y_size == y_size for item in items)
+
+
+def pack_tiled(items):
+    # Put items for which tiles_page is true onto pages without any collision checks. With a single item size every
+    # strategy fills the pages like pack_ordered, i.e. item i goes to slot i (going column by column) of the page grid.
+    x_size, y_size = items[0].x_size, items[0].y_size
+    rows = PAGE_SIZE // y_size
+    slots = rows * (PAGE_SIZE // x_size)
+    pages = []
+    for idx, item in enumerate(items):
+        page_idx, slot = divmod(idx, slots)
+        if page_idx == len(pages):
+            pages.append(Page())
+        x, y = slot // rows * x_size, slot % rows * y_size
+        item.set_position(x, y)
+        pages[page_idx].items.append(item)
+        pages[page_idx].allocate(x, x_size, y, y_size)
+    return pages
+
+
+def get_used_columns(page):
+    # Return the number of columns of the page up to the rightmost item
+    return max(item.get_position()[0] + item.x_size for item in page.items)
+
+
+def merge_pages(page, other, gap):
+    # Move the items of the other page onto the page, to the right of its items and leaving gap empty columns between
+    # them. Return whether the items fit onto the page.
+    offset = get_used_columns(page) + gap
+    if offset + get_used_columns(other) > PAGE_SIZE:
+        return False
+    for item in other.items:
+        x, y = item.get_position()
+        item.set_position(x + offset, y)
+        page.items.append(item)
+        page.allocate(x + offset, item.x_size, y, item.y_size)
+    return True
+
+
+# Values of the PackingStrategy setting of the ITEM_GROUP_ sections. Every strategy takes the items and a time limit in
+# milliseconds, which only pack_exact uses.
+packing_strategies = {
+    "ordered": pack_ordered,
+    "ffd": pack_first_fit_decreasing,
+    "bestfit": pack_best_fit,
+    "exact": pack_exact,
+}
+
+
+def pack(items, strategy, time_limit):
+    # Put the items of a group onto pages with the given packing strategy
+    if tiles_page(items):
+        return pack_tiled(items)
+    return packing_strategies[strategy](items, time_limit)
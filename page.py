@@ -1,39 +1,84 @@
+PAGE_SIZE = 10  # Stash pages are 10x10
+
+
+class Shape:
+    # Precomputed bit masks of an item size. The occupancy of a page is a 100 bit int, in which position (x, y) is bit
+    # x * 10 + y, so going through the bits in ascending order goes through the page column by column.
+    def __init__(self, x_size, y_size):
+        self.cell_offsets = [x * PAGE_SIZE + y for x in range(x_size) for y in range(y_size)]
+        mask = sum(1 << offset for offset in self.cell_offsets)
+        self.masks = {}  # Mask of the item at each (x, y) position in which it fits into the page
+        self.anchors = 0  # Bits of all positions in which the item fits into the page
+        for x in range(PAGE_SIZE - x_size + 1):
+            for y in range(PAGE_SIZE - y_size + 1):
+                self.masks[(x, y)] = mask << (x * PAGE_SIZE + y)
+                self.anchors |= 1 << (x * PAGE_SIZE + y)
+
+
+shapes = {}
+
+
+def get_shape(x_size, y_size):
+    if (x_size, y_size) not in shapes:
+        shapes[(x_size, y_size)] = Shape(x_size, y_size)
+    return shapes[(x_size, y_size)]
+
+
 class Page:
     # Page class for ordering items in physical space
     def __init__(self):
-        self.spaces = [[0] * 10 for _ in range(10)]  # Stash pages are 10x10
+        self.occupied = 0  # Bit mask of the occupied positions, see Shape
         self.items = []
+        self.data = None  # Stash data of the page if it is written back unchanged
 
     def is_collision(self, x_position, x_size, y_position, y_size):
         # Check if an item with size (x_size, y_size) inserted at position (x_position, y_position) collides with
         # ant existing item on the page
-        for x in range(x_size):
-            for y in range(y_size):
-                if x_position + x > 9 or y_position + y > 9 or \
-                        self.spaces[x_position + x][y_position + y] > 0:
-                    return True
-        return False
+        mask = get_shape(x_size, y_size).masks.get((x_position, y_position))
+        return mask is None or self.occupied & mask != 0
 
     def allocate(self, x_position, x_size, y_position, y_size):
         # Allocate the space for an item size (x_size, y_size) inserted at position (x_position, y_position)
-        for x in range(x_size):
-            for y in range(y_size):
-                self.spaces[x_position + x][y_position + y] += 1
+        self.occupied |= get_shape(x_size, y_size).masks[(x_position, y_position)]
+
+    def find_position(self, x_size, y_size):
+        # Return the first position (going column by column) at which an item with size (x_size, y_size) does not collide
+        # with any existing item on the page, or None. A position is blocked if any cell of the item placed there is
+        # occupied, so shifting the occupancy back by each cell's offset and or-ing gives all blocked positions at once.
+        shape = get_shape(x_size, y_size)
+        blocked = 0
+        for offset in shape.cell_offsets:
+            blocked |= self.occupied >> offset
+        free = shape.anchors & ~blocked
+        if not free:
+            return None
+        return divmod((free & -free).bit_length() - 1, PAGE_SIZE)
 
     def insert_item(self, item):
-        # Attempt to insert an item into the page. Go over each position in the page until either we find a position
-        # in which inserting the item will not collide with any existing items, in which case we allocate the space for
-        # the item as well as modify the item data to reflect the new location, or we run out of spaces.
-        # Return whether the item was inserted or not.
-        allocated = False
-        for x in range(10):
-            for y in range(10):
-                if not allocated and not self.is_collision(x, item.x_size, y, item.y_size):
-                    item.set_position(x, y)
-                    self.items.append(item)
-                    self.allocate(x, item.x_size, y, item.y_size)
-                    allocated = True
-        return allocated
+        # Attempt to insert an item into the page at the first position in which it will not collide with any existing
+        # items, in which case we allocate the space for the item as well as modify the item data to reflect the new
+        # location. Return whether the item was inserted or not.
+        position = self.find_position(item.x_size, item.y_size)
+        if position is None:
+            return False
+        x, y = position
+        item.set_position(x, y)
+        self.items.append(item)
+        self.allocate(x, item.x_size, y, item.y_size)
+        self.data = None
+        return True
+
+    def place_item(self, item):
+        # Attempt to insert an item into the page at its current position. Return whether the item was inserted or not.
+        x, y = item.get_position()
+        if self.is_collision(x, item.x_size, y, item.y_size):
+            return False
+        self.items.append(item)
+        self.allocate(x, item.x_size, y, item.y_size)
+        return True
 
     def num_items(self):
         return len(self.items)
+
+    def free_space(self):
+        return PAGE_SIZE * PAGE_SIZE - bin(self.occupied).count("1")
@@ -0,0 +1,161 @@
+from collections import Counter
+
+from item_data import CubeRecipe, get_gem_data_by_code, get_gem_data_by_type_and_quality, get_item_data, item_data
+from item_index import ItemIndex
+
+
+def get_gem_codes_to_check(gem_code, downgrade_gems):
+    # Return the code of the gem and, if gems may be downgraded, the codes of the gems of the same type with a higher
+    # quality, from low to high
+    gem_codes_to_check = [gem_code]
+    if downgrade_gems:
+        gem_data = get_gem_data_by_code(gem_code)
+        while True:
+            gem_data = get_gem_data_by_type_and_quality(gem_data.type, gem_data.quality + 1)
+            if gem_data is None:
+                break
+            else:
+                gem_codes_to_check.append(gem_data.code)
+    return gem_codes_to_check
+
+
+def get_upgrade_count(count, amount, keep_at_least, gives_back=0):
+    # Return how often amount items can be cubed while keeping keep_at_least of count items. gives_back is the number of
+    # items each upgrade adds to the count again, i.e. 1 if the item upgrades to itself.
+    return max(0, (count - keep_at_least - amount) // (amount - gives_back) + 1)
+
+
+def parse_cube_recipe(text):
+    # Parse a recipe like "3 r10 + gcy -> r11" (amount, item code, optional catalyst item code and the resulting item
+    # code) into a CubeRecipe. Raise a ValueError if the text is not a valid recipe.
+    ingredients, arrow, next_code = text.partition('->')
+    amount_and_code, _, catalyst_code = ingredients.partition('+')
+    try:
+        amount, code = amount_and_code.split()
+        recipe = CubeRecipe(int(amount), code, next_code.strip(), catalyst_code.strip() or None)
+    except ValueError:
+        raise ValueError("Invalid cube recipe: %s" % text) from None
+    if not arrow or recipe.catalyst_code == recipe.code:
+        raise ValueError("Invalid cube recipe: %s" % text)
+    for item_code in (recipe.code, recipe.next_code, recipe.catalyst_code):
+        if item_code is not None and item_code not in item_data:
+            raise ValueError("Unknown item code '%s' in cube recipe: %s" % (item_code, text))
+    # Every upgrade has to use up more items than it gives, otherwise the recipes could be cubed forever, and has to use
+    # up at least one item of its code
+    if recipe.amount + (recipe.catalyst_code is not None) < 2 or recipe.amount - (recipe.next_code == recipe.code) < 1:
+        raise ValueError("Cube recipe uses up too few items: %s" % text)
+    return recipe
+
+
+class UpgradePlan:
+    # Plan of the cube upgrades of the items, from a list of cube recipes. The upgrades are computed only from the number
+    # of items of every item code: every recipe is used as often as possible at once, in the order the recipes were
+    # added, and this is repeated until no recipe can be used anymore, e.g. because a later recipe gave the items for an
+    # earlier one. apply then changes the items according to the plan in a single pass.
+    def __init__(self, item_list):
+        self.counts = Counter(item.code for item in item_list)
+        self.recipes = []  # (recipe, keep_at_least, catalyst codes to check)
+        self.codes = {}  # Codes of all items which may be changed by the recipes, in order
+        self.steps = []  # (recipe, number of upgrades), or (None, gem code, number of downgrades) for a gem downgrade
+
+    def add_recipe(self, recipe, keep_at_least=0, downgrade_catalyst=False):
+        # Add a recipe keeping keep_at_least of its items. If downgrade_catalyst is set and the catalyst is a gem, a gem
+        # of the next higher quality is downgraded to three gems of the needed one, and so on.
+        catalyst_codes = []
+        if recipe.catalyst_code is not None:
+            is_gem = get_gem_data_by_code(recipe.catalyst_code) is not None
+            catalyst_codes = get_gem_codes_to_check(recipe.catalyst_code, downgrade_catalyst and is_gem)
+        self.recipes.append((recipe, keep_at_least, catalyst_codes))
+        for code in [recipe.code, recipe.next_code] + catalyst_codes:
+            self.codes.setdefault(code, None)
+
+    def run(self):
+        upgraded = True
+        while upgraded:
+            upgraded = False
+            for recipe, keep_at_least, catalyst_codes in self.recipes:
+                times = get_upgrade_count(self.counts[recipe.code], recipe.amount, keep_at_least,
+                                          int(recipe.next_code == recipe.code))
+                if catalyst_codes:
+                    times = min(times, sum(self.counts[code] * 3 ** idx for idx, code in enumerate(catalyst_codes)))
+                if times == 0:
+                    continue
+                if catalyst_codes:
+                    self.take_gems(catalyst_codes, times)
+                self.counts[recipe.code] -= recipe.amount * times
+                self.counts[recipe.next_code] += times
+                self.steps.append((recipe, times))
+                upgraded = True
+
+    def take_gems(self, gem_codes, needed):
+        # Take the needed number of gems of gem_codes[0], downgrading gems of the higher qualities in gem_codes (from low
+        # to high) if there are not enough. The downgrades are done from high to low.
+        downgrades = []
+        for idx, code in enumerate(gem_codes):
+            if idx > 0:
+                downgrades.append((None, code, needed))
+            taken = min(self.counts[code], needed)
+            self.counts[code] -= taken
+            needed -= taken
+            if needed == 0:
+                break
+            # Every gem of the next quality gives three gems of this one, the ones not needed are left over
+            next_needed = -(-needed // 3)
+            self.counts[code] += 3 * next_needed - needed
+            needed = next_needed
+        self.steps.extend(reversed(downgrades))
+
+    def print_plan(self):
+        downgrades = Counter()
+        upgrades = Counter()
+        for step in self.steps:
+            if step[0] is None:
+                downgrades[step[1]] += step[2]
+            else:
+                upgrades[step[0]] += step[1]
+        print("Upgrade plan:")
+        for code, times in downgrades.items():
+            gem_data = get_gem_data_by_code(code)
+            lower_gem_data = get_gem_data_by_type_and_quality(gem_data.type, gem_data.quality - 1)
+            print("  %s -> 3 x %s: %d times" % (get_item_data(code).name, get_item_data(lower_gem_data.code).name, times))
+        for recipe, times in upgrades.items():
+            ingredients = "%d x %s" % (recipe.amount, get_item_data(recipe.code).name)
+            if recipe.catalyst_code is not None:
+                ingredients += " + %s" % get_item_data(recipe.catalyst_code).name
+            print("  %s -> %s: %d times" % (ingredients, get_item_data(recipe.next_code).name, times))
+
+    def apply(self, item_list):
+        # Change the items according to the plan and return the new item list. All items which may be changed by the
+        # recipes are put at the end of the item list, by the order of their codes in the recipes.
+        if not self.steps:
+            return item_list
+        others = []
+        index = ItemIndex()
+        for item in item_list:
+            if item.code in self.codes:
+                index.add(item)
+            else:
+                others.append(item)
+
+        for step in self.steps:
+            if step[0] is None:
+                _, code, times = step
+                gem_data = get_gem_data_by_code(code)
+                lower_code = get_gem_data_by_type_and_quality(gem_data.type, gem_data.quality - 1).code
+                for _ in range(times):
+                    gem = index.pop_first(code)
+                    gem.set_code(lower_code)
+                    for new_gem in (gem, gem.copy(), gem.copy()):
+                        index.add(new_gem)
+            else:
+                recipe, times = step
+                for _ in range(times):
+                    # The first items of the catalyst and the last items of the recipe's code are cubed
+                    if recipe.catalyst_code is not None:
+                        index.pop_first(recipe.catalyst_code)
+                    for _ in range(recipe.amount):
+                        item = index.pop_last(recipe.code)
+                    item.set_code(recipe.next_code)
+                    index.add(item)
+
+        return others + index.get_items(self.codes)